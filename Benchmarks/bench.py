@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Benchmark of the exploration techniques on the small targets in targets/ (build them with `make`).
+
+Every (target, technique) run goes in a fresh process with fixed seeds and records states/sec,
+coverage over time, peak RSS and per-step latency. Results are compared against a baseline JSON
+to catch regressions.
+
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+l = logging.getLogger('bench')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(ROOT)
+BIN_DIR = os.path.join(ROOT, 'bin')
+
+
+def _add_paths():
+    # the techniques and the utils are plain modules, as if their folders were in the PYTHONPATH
+    for folder in sorted(glob.glob(os.path.join(REPO, 'ExplorationTechniques', '*')) +
+                         glob.glob(os.path.join(REPO, 'Utils', '*'))):
+        if os.path.isdir(folder) and folder not in sys.path:
+            sys.path.append(folder)
+
+
+def _techniques(name):
+    """
+    Techniques to plug in for a benchmark name (none for the default BFS of the SimulationManager).
+    """
+    import angr
+    from ExplosionDetector import ExplosionDetector
+    from heartbeat import HeartBeat
+    from KLEECoverageOS import KLEECoverageOptimizeSearch
+    from KLEERandomSearch import KLEERandomSearch
+    from LoopExhaustion import AEGLoopExhaustion
+    from MemLimiter import MemLimiter
+    from SimgrViz import SimgrViz
+    from StocasticSearch import StochasticSearch
+
+    return {
+        'bfs': lambda: [],
+        'dfs': lambda: [angr.exploration_techniques.DFS()],
+        'klee_coverage': lambda: [KLEECoverageOptimizeSearch()],
+        'klee_random': lambda: [KLEERandomSearch()],
+        'loop_exhaustion': lambda: [AEGLoopExhaustion()],
+        'stochastic': lambda: [StochasticSearch()],
+        'simgr_viz': lambda: [SimgrViz()],
+        'explosion_detector': lambda: [ExplosionDetector(threshold=1000, shedding=True)],
+        'mem_limiter': lambda: [MemLimiter(max_mem=64, drop_errored=True)],
+        'heartbeat': lambda: [HeartBeat(beat_interval=10 ** 9, interactive=False)],
+    }[name]()
+
+
+TECHNIQUES = ('bfs', 'dfs', 'klee_coverage', 'klee_random', 'loop_exhaustion', 'stochastic',
+              'simgr_viz', 'explosion_detector', 'mem_limiter', 'heartbeat')
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_one(target, technique, seed, max_steps, max_time):
+    """
+    One benchmark run, meant to be called in a fresh process (the peak RSS is the one of the process).
+    """
+    _add_paths()
+    import angr
+    logging.getLogger('angr').setLevel('ERROR')
+
+    random.seed(seed)
+    project = angr.Project(os.path.join(BIN_DIR, target), auto_load_libs=False)
+    simgr = project.factory.simulation_manager(project.factory.entry_state())
+    for t in _techniques(technique):
+        simgr.use_technique(t)
+
+    covered = set()
+    coverage = []
+    latencies = []
+    n_states = 0
+    started = time.perf_counter()
+    for _ in range(max_steps):
+        if not simgr.active or time.perf_counter() - started > max_time:
+            break
+        before = time.perf_counter()
+        simgr.step()
+        latencies.append(time.perf_counter() - before)
+        for state in simgr.active:
+            n_states += 1
+            covered.add(state.addr)
+        coverage.append((round(time.perf_counter() - started, 3), len(covered)))
+    elapsed = time.perf_counter() - started
+
+    return dict(
+        target=target,
+        technique=technique,
+        seed=seed,
+        steps=len(latencies),
+        elapsed=elapsed,
+        states_per_sec=n_states / elapsed if elapsed else 0.,
+        coverage=len(covered),
+        # at most 100 points of the coverage curve
+        coverage_over_time=coverage[::max(1, len(coverage) // 100)],
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        step_latency=dict(p50=_percentile(latencies, .5), p90=_percentile(latencies, .9),
+                          p99=_percentile(latencies, .99), max=max(latencies, default=0.)),
+    )
+
+
+def compare(results, baseline, tolerance):
+    """
+    List the regressions of results with respect to baseline, both keyed by 'target/technique'.
+    """
+    regressions = []
+    for key, res in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        checks = [
+            ('states_per_sec', res['states_per_sec'] < base['states_per_sec'] * (1 - tolerance)),
+            ('coverage', res['coverage'] < base['coverage']),
+            ('peak_rss', res['peak_rss'] > base['peak_rss'] * (1 + tolerance)),
+            ('step_latency.p99', res['step_latency']['p99'] > base['step_latency']['p99'] * (1 + tolerance)),
+        ]
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append((key, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the exploration techniques.')
+    parser.add_argument('--targets', nargs='*', help='Targets in bin/ (default: all)')
+    parser.add_argument('--techniques', nargs='*', default=TECHNIQUES, choices=TECHNIQUES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-steps', type=int, default=2000)
+    parser.add_argument('--max-time', type=float, default=60.)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against this JSON file, exit 1 on regressions')
+    parser.add_argument('--save-baseline', help='Write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown (default 0.2)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    targets = args.targets or (sorted(os.listdir(BIN_DIR)) if os.path.isdir(BIN_DIR) else [])
+    if not targets:
+        l.error(f'No targets in {BIN_DIR}, run make first')
+        return 2
+
+    results = dict()
+    ctx = multiprocessing.get_context('spawn')
+    for target in targets:
+        for technique in args.techniques:
+            with ctx.Pool(1) as pool:
+                res = pool.apply(run_one, (target, technique, args.seed, args.max_steps, args.max_time))
+            results[f'{target}/{technique}'] = res
+            l.info(f'{target:<10} {technique:<20} {res["states_per_sec"]:>9.1f} states/s '
+                   f'{res["coverage"]:>5} blocks {res["peak_rss"] / 2 ** 20:>7.1f} MiB '
+                   f'p99 {res["step_latency"]["p99"] * 1e3:>8.2f} ms')
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, 'w') as fp:
+                json.dump(results, fp, indent=1, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for key, metric in regressions:
+            l.error(f'Regression: {key} {metric}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
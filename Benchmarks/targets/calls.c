@@ -0,0 +1,44 @@
+/* A deep chain of calls, each level branching on one input byte. */
+#include <stdio.h>
+#include <unistd.h>
+
+static unsigned char buf[16];
+
+#define LEVEL(n, next) \
+    __attribute__((noinline)) static int level##n(int acc) \
+    { \
+        if (buf[n] > 0x80) \
+            return next(acc + n); \
+        return next(acc ^ n); \
+    }
+
+__attribute__((noinline)) static int bottom(int acc)
+{
+    if (acc == 0x42)
+        puts("bottom");
+    return acc;
+}
+
+LEVEL(15, bottom)
+LEVEL(14, level15)
+LEVEL(13, level14)
+LEVEL(12, level13)
+LEVEL(11, level12)
+LEVEL(10, level11)
+LEVEL(9, level10)
+LEVEL(8, level9)
+LEVEL(7, level8)
+LEVEL(6, level7)
+LEVEL(5, level6)
+LEVEL(4, level5)
+LEVEL(3, level4)
+LEVEL(2, level3)
+LEVEL(1, level2)
+LEVEL(0, level1)
+
+int main(void)
+{
+    if (read(0, buf, sizeof(buf)) != sizeof(buf))
+        return 1;
+    return level0(0) & 1;
+}
@@ -0,0 +1,20 @@
+/* Independent branches on every input byte: 2^32 paths. */
+#include <stdio.h>
+#include <unistd.h>
+
+int main(void)
+{
+    unsigned char buf[32];
+    int i, count = 0;
+
+    if (read(0, buf, sizeof(buf)) != sizeof(buf))
+        return 1;
+
+    for (i = 0; i < sizeof(buf); i++) {
+        if (buf[i] == 'X')
+            count++;
+    }
+    if (count == sizeof(buf))
+        puts("all");
+    return 0;
+}
@@ -0,0 +1,22 @@
+/* Nested loops whose trip counts depend on the input. */
+#include <stdio.h>
+#include <unistd.h>
+
+int main(void)
+{
+    unsigned char buf[8];
+    int i, j, acc = 0;
+
+    if (read(0, buf, sizeof(buf)) != sizeof(buf))
+        return 1;
+
+    for (i = 0; i < buf[0] % 16; i++) {
+        for (j = 0; j < buf[1] % 16; j++) {
+            if (buf[2 + (i + j) % 6] == 'A' + j)
+                acc++;
+        }
+    }
+    if (acc == 7)
+        puts("deep");
+    return 0;
+}
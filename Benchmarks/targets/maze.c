@@ -0,0 +1,43 @@
+/* A 8x8 maze walked with the w/a/s/d moves read from the input. */
+#include <stdio.h>
+#include <unistd.h>
+
+static const char maze[8][9] = {
+    "+-+----+",
+    "| |   #|",
+    "| | +-+|",
+    "|   |  |",
+    "+-+ | ||",
+    "|   | ||",
+    "| +-+  |",
+    "+------+",
+};
+
+int main(void)
+{
+    char moves[24];
+    int x = 1, y = 1, i;
+
+    if (read(0, moves, sizeof(moves)) != sizeof(moves))
+        return 1;
+
+    for (i = 0; i < sizeof(moves); i++) {
+        int nx = x, ny = y;
+        switch (moves[i]) {
+        case 'w': ny--; break;
+        case 's': ny++; break;
+        case 'a': nx--; break;
+        case 'd': nx++; break;
+        default: return 1;
+        }
+        if (maze[ny][nx] == '#') {
+            puts("win");
+            return 0;
+        }
+        if (maze[ny][nx] != ' ')
+            return 1;
+        x = nx;
+        y = ny;
+    }
+    return 1;
+}
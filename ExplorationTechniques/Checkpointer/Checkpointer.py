@@ -0,0 +1,259 @@
+import io
+import logging
+import os
+import pickle
+import time
+import weakref
+
+from angr.exploration_techniques import ExplorationTechnique
+from SpillStash import SpilledState, dumps, loads
+
+l = logging.getLogger('Checkpointer')
+
+MANIFEST = 'manifest.pickle'
+
+
+def _fsync_dir(path):
+    # make the new directory entries (and the rename of the manifest) durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _TechniquePickler(pickle.Pickler):
+    # states of the stashes are written to their own files, techniques only refer to them
+    def __init__(self, fp, project, sids):
+        super(_TechniquePickler, self).__init__(fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.project = project
+        self.sids = sids
+
+    def persistent_id(self, obj):
+        if obj is self.project:
+            return ('project',)
+        sid = self.sids.get(id(obj))
+        if sid is not None:
+            return ('state', sid)
+        return None
+
+
+class _TechniqueUnpickler(pickle.Unpickler):
+    def __init__(self, fp, project, states):
+        super(_TechniqueUnpickler, self).__init__(fp)
+        self.project = project
+        self.states = states
+
+    def persistent_load(self, pid):
+        if pid[0] == 'project':
+            return self.project
+        if pid[0] == 'state':
+            return self.states[pid[1]]
+        raise pickle.UnpicklingError(f'unknown persistent id {pid!r}')
+
+
+class Checkpointer(ExplorationTechnique):
+    """
+    Periodic, crash-safe checkpoints of the stashes and of the state of the other techniques.
+
+    Every state is written once to its own file: states are not changed once they leave 'active',
+    so only the active states and the states created since the last checkpoint are pickled again.
+    The attributes of every technique are pickled with references to the stashed states, so
+    structures like the fork tree of KLEERandomSearch keep pointing to the same states on resume.
+    Attributes that cannot be pickled (threads, files, ...) and the ones listed in the
+    `checkpoint_exclude` attribute of a technique are skipped, they are rebuilt by its setup.
+    A checkpoint is complete once its manifest replaced the previous one, the files of the states
+    that are not referenced anymore are removed afterwards. State files, the manifest and the
+    directories holding them are fsynced first, so a checkpoint also survives a power loss.
+    Attributes keyed by id() go stale once unpickled: techniques either exclude them or rebuild
+    them in their `resumed(simgr)` method.
+    The stubs of paged out states (see SpillStash) are saved as the states they stand for, and
+    resumed in memory: the SpillStash of the resumed techniques pages them out again.
+    """
+
+    def __init__(self, directory, every_steps=100, every_seconds=None, stashes=None):
+        """
+        :param directory:     Where the checkpoint is written.
+        :param every_steps:   Steps between two checkpoints (default 100, None to disable).
+        :param every_seconds: Seconds between two checkpoints (default None, disabled).
+        :param stashes:       Stashes to save (default: all of them).
+        """
+        super(Checkpointer, self).__init__()
+        self.directory = directory
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.stashes = stashes
+        self.steps = 0
+        self.checkpoints = 0
+        self._last_step = 0
+        self._last_time = time.perf_counter()
+        self._next_sid = 0
+        # id(state) -> (weakref to the state, sid of its file)
+        self._written = dict()
+        os.makedirs(os.path.join(directory, 'states'), exist_ok=True)
+
+    def step(self, simgr, stash='active', **kwargs):
+        simgr = simgr.step(stash=stash, **kwargs)
+        self.steps += 1
+        if (self.every_steps is not None and self.steps - self._last_step >= self.every_steps) or \
+                (self.every_seconds is not None and time.perf_counter() - self._last_time >= self.every_seconds):
+            self.checkpoint(simgr)
+        return simgr
+
+    def checkpoint(self, simgr):
+        started = time.perf_counter()
+        project = simgr._project
+        names = self.stashes if self.stashes is not None else [name for name, states in simgr.stashes.items() if states]
+
+        written = dict()
+        stashes = dict()
+        n_new = 0
+        for name in names:
+            stashes[name] = []
+            for state in simgr.stashes[name]:
+                ref, sid = self._written.get(id(state), (None, None))
+                if name == 'active' or ref is None or ref() is not state:
+                    sid = self._write_state(project, state)
+                    if sid is None:
+                        continue
+                    n_new += 1
+                written[id(state)] = (weakref.ref(state), sid)
+                stashes[name].append(sid)
+
+        if n_new:
+            _fsync_dir(os.path.join(self.directory, 'states'))
+        sids = {key: sid for key, (_, sid) in written.items()}
+        techniques = [(type(t).__name__, self._dump_technique(t, project, sids))
+                      for t in simgr._techniques if t is not self]
+
+        manifest = dict(steps=self.steps, stashes=stashes, techniques=techniques)
+        tmp_path = os.path.join(self.directory, MANIFEST + '.tmp')
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(manifest, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, MANIFEST))
+        _fsync_dir(self.directory)
+
+        # the new manifest is in place, drop the files it does not refer to
+        live = {sid for _, sid in written.values()}
+        for _, sid in self._written.values():
+            if sid not in live:
+                self._remove_state(sid)
+        self._written = written
+
+        self.checkpoints += 1
+        self._last_step = self.steps
+        self._last_time = time.perf_counter()
+        l.debug(f'checkpoint {self.checkpoints}: {n_new} states written, {len(live)} kept, '
+                f'{time.perf_counter() - started:.2f}s')
+
+    def _state_path(self, sid):
+        return os.path.join(self.directory, 'states', f'{sid}.state')
+
+    def _write_state(self, project, state):
+        sid = self._next_sid
+        self._next_sid += 1
+        try:
+            if isinstance(state, SpilledState):
+                # the spill file goes away once the stub is paged in, the checkpoint keeps a copy
+                with open(state.path, 'rb') as fp:
+                    data = fp.read()
+            else:
+                data = dumps(state, project)
+        except Exception as e:
+            l.warning(f'Could not checkpoint {state}: {e}')
+            return None
+        with open(self._state_path(sid), 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        return sid
+
+    def _remove_state(self, sid):
+        try:
+            os.remove(self._state_path(sid))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _dump_technique(technique, project, sids):
+        exclude = set(getattr(technique, 'checkpoint_exclude', ()))
+        attrs = {k: v for k, v in vars(technique).items() if k not in exclude}
+
+        def dump(obj):
+            fp = io.BytesIO()
+            _TechniquePickler(fp, project, sids).dump(obj)
+            return fp.getvalue()
+
+        try:
+            return [dump(attrs)]
+        except Exception:
+            pass
+        # one attribute at a time, skipping the ones that cannot be pickled
+        blobs = []
+        for k, v in attrs.items():
+            try:
+                blobs.append(dump({k: v}))
+            except Exception as e:
+                l.debug(f'not checkpointing {type(technique).__name__}.{k}: {e}')
+        return blobs
+
+    @classmethod
+    def resume(cls, project, directory, techniques=(), **kwargs):
+        """
+        Rebuild the SimulationManager of the last complete checkpoint in directory.
+
+        :param project:    The project the exploration was running on.
+        :param techniques: Fresh instances of the techniques the exploration was using, in the same order.
+                           They are set up on the resumed stashes and then get their saved attributes back.
+        :param kwargs:     Passed to the new Checkpointer, which is plugged in last.
+        :return:           The SimulationManager.
+        """
+        with open(os.path.join(directory, MANIFEST), 'rb') as fp:
+            manifest = pickle.load(fp)
+
+        states = dict()
+        stashes = dict()
+        for name, sids in manifest['stashes'].items():
+            stashes[name] = []
+            for sid in sids:
+                with open(os.path.join(directory, 'states', f'{sid}.state'), 'rb') as fp:
+                    states[sid] = loads(fp.read(), project)
+                stashes[name].append(states[sid])
+
+        simgr = project.factory.simulation_manager(stashes.pop('active', []))
+        for name, stashed in stashes.items():
+            simgr.stashes[name] = stashed
+        for t in techniques:
+            simgr.use_technique(t)
+
+        # techniques added by the setup of others (i.e., LoopSeer) are matched too, by name and order
+        todo = list(manifest['techniques'])
+        for t in simgr._techniques:
+            for i, (name, blobs) in enumerate(todo):
+                if name == type(t).__name__:
+                    for blob in blobs:
+                        vars(t).update(_TechniqueUnpickler(io.BytesIO(blob), project, states).load())
+                    if hasattr(t, 'resumed'):
+                        t.resumed(simgr)
+                    del todo[i]
+                    break
+        for name, _ in todo:
+            l.warning(f'No {name} to resume')
+
+        checkpointer = cls(directory, **kwargs)
+        checkpointer.steps = checkpointer._last_step = manifest['steps']
+        # states of the checkpoint are not written again until they change stash
+        checkpointer._next_sid = max(states, default=-1) + 1
+        for name, sids in manifest['stashes'].items():
+            for sid in sids:
+                checkpointer._written[id(states[sid])] = (weakref.ref(states[sid]), sid)
+        # states written after the manifest by a run that died before replacing it
+        for filename in os.listdir(os.path.join(directory, 'states')):
+            sid = int(filename.split('.')[0]) if filename.split('.')[0].isdigit() else None
+            if sid is not None and sid not in states:
+                checkpointer._remove_state(sid)
+        simgr.use_technique(checkpointer)
+        l.info(f'Resumed {simgr} at step {checkpointer.steps}')
+        return simgr
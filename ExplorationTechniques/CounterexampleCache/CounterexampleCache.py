@@ -0,0 +1,204 @@
+import logging
+import time
+from collections import OrderedDict
+
+from angr.exploration_techniques import ExplorationTechnique
+from angr.state_plugins.solver import SimSolver
+
+l = logging.getLogger('CounterexampleCache')
+
+
+class SolverCache(object):
+    """
+    KLEE's counterexample cache. https://hci.stanford.edu/cstr/reports/2008-03.pdf
+
+    Satisfiability results keyed by the set of the hashes of the constraints, so that the order
+    and the duplicates of the constraints do not matter. Besides exact hits, a query is answered by
+        1. a cached unsat subset: the query is unsat too,
+        2. a cached sat superset: the query is sat too.
+    Sat entries are indexed under each of their constraints and supersets are looked for among the
+    entries of the rarest constraint of the query. Unsat entries are only indexed under their rarest
+    constraint when stored, so looking for a subset walks a short posting list per constraint.
+    Path-prefix constraints are shared by nearly every entry, so at most max_scan candidates are
+    checked per lookup: a miss costs O(max_scan), not O(entries).
+    At most max_entries entries are kept (least recently used first out).
+    """
+
+    def __init__(self, max_entries=100000, max_scan=64):
+        self.max_entries = max_entries
+        self.max_scan = max_scan
+        # key -> sat
+        self.entries = OrderedDict()
+        # constraint hash -> keys of the sat entries holding it
+        self.sat_index = dict()
+        # constraint hash -> keys of the unsat entries indexed under it
+        self.unsat_index = dict()
+        # unsat key -> the constraint it is indexed under
+        self.unsat_slot = dict()
+        self.hits = dict(exact=0, unsat_subset=0, sat_superset=0)
+        self.misses = 0
+        self.solver_time = 0.
+
+    @staticmethod
+    def key(constraints):
+        try:
+            return frozenset(c.hash() for c in constraints)
+        except AttributeError:
+            # a concrete python bool among the constraints
+            return None
+
+    def lookup(self, key):
+        """
+        :return: True/False, or None when the cache does not know.
+        """
+        sat = self.entries.get(key)
+        if sat is not None:
+            self.entries.move_to_end(key)
+            self.hits['exact'] += 1
+            return sat
+
+        if key and self._sat_superset(key):
+            self.hits['sat_superset'] += 1
+            return True
+
+        if self._unsat_subset(key):
+            self.hits['unsat_subset'] += 1
+            return False
+
+        self.misses += 1
+        return None
+
+    def _sat_superset(self, key):
+        candidates = None
+        for c in key:
+            postings = self.sat_index.get(c)
+            if not postings:
+                return False
+            if candidates is None or len(postings) < len(candidates):
+                candidates = postings
+        for n, other in enumerate(candidates):
+            if n == self.max_scan:
+                break
+            if key <= other:
+                self.entries.move_to_end(other)
+                return True
+        return False
+
+    def _unsat_subset(self, key):
+        scanned = 0
+        for c in key:
+            for other in self.unsat_index.get(c, ()):
+                if other <= key:
+                    self.entries.move_to_end(other)
+                    return True
+                scanned += 1
+                if scanned >= self.max_scan:
+                    return False
+        return False
+
+    def store(self, key, sat, solver_time=0.):
+        self.solver_time += solver_time
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = sat
+        if sat:
+            for c in key:
+                self.sat_index.setdefault(c, set()).add(key)
+        elif key:
+            # the constraint with the shortest list, any one of them finds the entry from a superset
+            c = min(key, key=lambda c: len(self.unsat_index.get(c, ())))
+            self.unsat_slot[key] = c
+            self.unsat_index.setdefault(c, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            old, old_sat = self.entries.popitem(last=False)
+            if old_sat:
+                self._unindex(self.sat_index, old, old)
+            elif old:
+                self._unindex(self.unsat_index, old, (self.unsat_slot.pop(old),))
+
+    @staticmethod
+    def _unindex(index, key, constraints):
+        for c in constraints:
+            postings = index[c]
+            postings.discard(key)
+            if not postings:
+                del index[c]
+
+    @property
+    def hit_rate(self):
+        hits = sum(self.hits.values())
+        return hits / (hits + self.misses) if hits + self.misses else 0.
+
+    @property
+    def saved_time(self):
+        # every hit saved an average miss
+        return sum(self.hits.values()) * self.solver_time / self.misses if self.misses else 0.
+
+    def report(self):
+        return "%.1f%% hits (%s), %d misses, %d entries, %.2fs in the solver, ~%.2fs saved" % (
+            100 * self.hit_rate, ', '.join('%d %s' % (n, kind) for kind, n in self.hits.items()),
+            self.misses, len(self.entries), self.solver_time, self.saved_time)
+
+
+class CounterexampleCache(ExplorationTechnique):
+    """
+    Answer the satisfiability checks of every state (i.e., the ones of the successors of a fork)
+    from a SolverCache shared by all the states of the SimulationManager.
+
+    SimSolver.satisfiable goes through the cache only while this SimulationManager steps: it is
+    patched when a step starts and restored when it ends, so other SimulationManagers of the
+    process are not affected. Queries with extra constraints are cached too, and the stats are
+    logged every `report_interval` steps.
+    """
+
+    def __init__(self, cache=None, report_interval=1000):
+        """
+        :param cache:           The SolverCache (default: a new one with the default size).
+        :param report_interval: Steps between two reports of the hit rate (default 1000, None to disable).
+        """
+        super(CounterexampleCache, self).__init__()
+        self.cache = cache if cache is not None else SolverCache()
+        self.report_interval = report_interval
+        self.steps = 0
+        self._original = None
+
+    def install(self):
+        if self._original is not None:
+            return False
+        self._original = original = SimSolver.satisfiable
+        cache = self.cache
+
+        def satisfiable(solver, extra_constraints=(), exact=None):
+            # approximate answers are not cached
+            key = cache.key(list(solver.constraints) + list(extra_constraints)) if exact is not False else None
+            if key is None:
+                return original(solver, extra_constraints=extra_constraints, exact=exact)
+            found = cache.lookup(key)
+            if found is not None:
+                return found
+            started = time.perf_counter()
+            sat = original(solver, extra_constraints=extra_constraints, exact=exact)
+            cache.store(key, sat, solver_time=time.perf_counter() - started)
+            return sat
+
+        SimSolver.satisfiable = satisfiable
+        return True
+
+    def uninstall(self):
+        if self._original is not None:
+            SimSolver.satisfiable = self._original
+            self._original = None
+
+    def step(self, simgr, stash='active', **kwargs):
+        # nested in another CounterexampleCache step: leave its patch alone
+        installed = self.install()
+        try:
+            simgr = simgr.step(stash=stash, **kwargs)
+        finally:
+            if installed:
+                self.uninstall()
+        self.steps += 1
+        if self.report_interval and self.steps % self.report_interval == 0:
+            l.info(self.cache.report())
+        return simgr
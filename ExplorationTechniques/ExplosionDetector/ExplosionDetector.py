@@ -1,33 +1,178 @@
+import logging
+import random
+from threading import Event
+
 from angr.exploration_techniques import ExplorationTechnique
 
+l = logging.getLogger('ExplosionDetector')
+
+
+def depth(state):
+    # states paged out by a SpillStash have no history, they go first
+    history = getattr(state, 'history', None)
+    return history.depth if history is not None else 0
+
+
+def state_key(state):
+    """
+    Address and call stack of a state, None when the state has no call stack to compare.
+    """
+    callstack = getattr(state, 'callstack', None)
+    if callstack is None:
+        return None
+    return state.addr, tuple(frame.func_addr for frame in callstack)
+
+
+def kth_largest(values, k, rng=random):
+    """
+    Expected O(n) selection (quickselect) of the k-th largest value, 1 <= k <= len(values).
+    """
+    values = list(values)
+    while True:
+        pivot = values[rng.randrange(len(values))]
+        above = [v for v in values if v > pivot]
+        if k <= len(above):
+            values = above
+            continue
+        n_equal = sum(1 for v in values if v == pivot)
+        if k <= len(above) + n_equal:
+            return pivot
+        k -= len(above) + n_equal
+        values = [v for v in values if v < pivot]
+
+
+def shed(states, target, ranker=depth, dedupe=True):
+    """
+    Keep at most target states, the highest ranked ones, in O(n) without sorting.
+
+    With dedupe only the highest ranked state among the ones sharing address and call stack is kept.
+    Returns the kept states in their original order.
+    """
+    ranks = [ranker(s) for s in states]
+    candidates = range(len(states))
+    if dedupe:
+        best = dict()
+        marked = bytearray(len(states))
+        for i, s in enumerate(states):
+            key = state_key(s)
+            if key is None:
+                marked[i] = 1
+            elif key not in best or ranks[i] > ranks[best[key]]:
+                best[key] = i
+        for i in best.values():
+            marked[i] = 1
+        # back in the original order in a single scan
+        candidates = [i for i in range(len(states)) if marked[i]]
+    if len(candidates) <= target:
+        return [states[i] for i in candidates]
+    if target <= 0:
+        return []
+
+    pivot = kth_largest((ranks[i] for i in candidates), target)
+    n_equal = target - sum(1 for i in candidates if ranks[i] > pivot)
+    kept = []
+    for i in candidates:
+        if ranks[i] > pivot:
+            kept.append(states[i])
+        elif ranks[i] == pivot and n_equal > 0:
+            kept.append(states[i])
+            n_equal -= 1
+    return kept
+
+
 class ExplosionDetector(ExplorationTechnique):
-    def __init__(self, stashes=('active', 'deferred', 'errored', 'cut'), threshold=100):
+    def __init__(self, stashes=('active', 'deferred', 'errored', 'cut'), threshold=100, watchdog=None,
+                 shedding=False, target=None, ranker=depth, dedupe=True):
+        """
+        :param stashes:   The stashes counted against the threshold and dropped when stopping.
+        :param threshold: Number of states that stops the exploration.
+        :param watchdog:  A Watchdog with the time/step/solver budgets driving timed_out (default None).
+        :param shedding:  Trim the stashes back to target states instead of dropping everything
+                          when the threshold is crossed.
+        :param target:    Number of states kept when shedding (default half the threshold).
+        :param ranker:    state -> value, the highest valued states are kept (default: depth).
+                          The rank functions of the search techniques can be used as they are.
+        :param dedupe:    Keep one state among the ones sharing address and call stack.
+        """
         super(ExplosionDetector, self).__init__()
         self._stashes = stashes
         self._threshold = threshold
+        self.shedding = shedding
+        self.target = target if target is not None else threshold // 2
+        self.ranker = ranker
+        self.dedupe = dedupe
+        self.shed_count = 0
         self.timed_out = Event()
         self.timed_out_bool = False
+        self.watchdog = watchdog
+        self.snapshot = None
+        if watchdog is not None:
+            watchdog.expired = self.timed_out
+
+    def setup(self, simgr):
+        super(ExplosionDetector, self).setup(simgr)
+        if self.watchdog is not None:
+            self.watchdog.start()
 
     def step(self, simgr, stash='active', **kwargs):
-        simgr = simgr.step(stash=stash, **kwargs)
+        # the budgets are only checked at step boundaries
+        if not self.timed_out.is_set():
+            simgr = simgr.step(stash=stash, **kwargs)
+            if self.watchdog is not None:
+                self.watchdog.charge_step()
         total = 0
         if len(simgr.unconstrained) > 0:
             l.debug("Nuking unconstrained")
-            simgr.move(from_stash='unconstrained', to_stash='_Drop', filter_func=lambda _: True)
-        if self.timed_out.is_set():
+            simgr.drop(stash='unconstrained')
+        for st in self._stashes:
+            if hasattr(simgr, st):
+                total += len(getattr(simgr, st))
+        if self.timed_out.is_set() and not self.timed_out_bool:
             l.critical("Timed out, %d states: %s" % (total, str(simgr)))
             self.timed_out_bool = True
+            self.take_snapshot(simgr)
             for st in self._stashes:
                 if hasattr(simgr, st):
-                    simgr.move(from_stash=st, to_stash='_Drop', filter_func=lambda _: True)
-        for st in self._stashes:
-            if hasattr(simgr, st):
-                total += len(getattr(simgr, st))
+                    simgr.drop(stash=st)
+            return simgr
 
-        if total >= self._threshold:
+        if total >= self._threshold and self.shedding:
+            self.shed(simgr)
+            l.warning("State explosion detected, over %d states, shed to: %s" % (total, str(simgr)))
+        elif total >= self._threshold:
             l.critical("State explosion detected, over %d states: %s" % (total, str(simgr)))
+            self.take_snapshot(simgr)
             for st in self._stashes:
                 if hasattr(simgr, st):
-                    simgr.move(from_stash=st, to_stash='_Drop', filter_func=lambda _: True)
+                    simgr.drop(stash=st)
+
+        return simgr
+
+    def shed(self, simgr):
+        # errored stashes hold ErrorRecords, they are dropped and not ranked
+        stashes = [st for st in self._stashes if hasattr(simgr, st)]
+        if 'errored' in stashes:
+            del simgr.errored[:]
+            stashes.remove('errored')
+
+        pool = [s for st in stashes for s in simgr.stashes[st]]
+        kept = {id(s) for s in shed(pool, self.target, ranker=self.ranker, dedupe=self.dedupe)}
+        self.shed_count += len(pool) - len(kept)
+        for st in stashes:
+            simgr.drop(stash=st, filter_func=lambda s: id(s) not in kept)
+        # let the search techniques drop their references to the shed states (see MemLimiter)
+        dropped = [s for s in pool if id(s) not in kept]
+        for t in simgr._techniques:
+            if dropped and hasattr(t, 'evict'):
+                t.evict(dropped)
+
+    def complete(self, simgr):
+        return self.timed_out_bool
 
-        return simgr
\ No newline at end of file
+    def take_snapshot(self, simgr):
+        # what was left when the exploration was stopped, for batch drivers
+        self.snapshot = dict(stashes={name: len(states) for name, states in simgr.stashes.items() if states})
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.snapshot.update(self.watchdog.report())
+        return self.snapshot
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+l = logging.getLogger("HeartBeatMetrics")
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class MetricsExporter(object):
+    '''
+    Live metrics of an exploration in the Prometheus text format.
+
+    HeartBeat feeds it with every stepped state, and every `interval` seconds the metrics
+    (steps/sec, successors per step, states per stash, RSS, seconds since new coverage)
+    are rendered and written atomically to `path` (i.e., for the node_exporter textfile
+    collector) and/or served on http://127.0.0.1:`port`/metrics by a daemon thread.
+
+    Sending `snapshot_signal` to the process asks for a snapshot of the SimulationManager:
+    the handler only sets a flag, the JSON dump is written to `snapshot_dir` at the next step.
+    '''
+    def __init__(self, path=None, port=None, interval=5., snapshot_signal=signal.SIGUSR1, snapshot_dir="/tmp"):
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self.process = psutil.Process(os.getpid()) if psutil is not None else None
+
+        self.steps = 0
+        self.successors = 0
+        self.covered = set()
+        self.started = time.time()
+        self.last_new_coverage = self.started
+        self.text = ""
+
+        self._last_export = self.started
+        self._last_steps = 0
+        self._last_successors = 0
+        self._snapshot_requested = False
+        self._server = None
+
+        if snapshot_signal is not None:
+            try:
+                signal.signal(snapshot_signal, self._request_snapshot)
+            except ValueError:
+                # signal handlers can only be installed from the main thread
+                l.warning("Not in the main thread, snapshots on signal are disabled")
+        if port is not None:
+            self._serve(port)
+
+    def record(self, simgr, state, succs):
+        self.steps += 1
+        self.successors += len(succs)
+        for succ in succs:
+            if succ.addr not in self.covered:
+                self.covered.add(succ.addr)
+                self.last_new_coverage = time.time()
+
+        if self._snapshot_requested:
+            self._snapshot_requested = False
+            self.snapshot(simgr)
+        if time.time() - self._last_export >= self.interval:
+            self.export(simgr)
+
+    def render(self, simgr):
+        now = time.time()
+        window = max(now - self._last_export, 1e-9)
+        steps = self.steps - self._last_steps
+        lines = [
+            "# TYPE heartbeat_steps_total counter",
+            "heartbeat_steps_total %d" % self.steps,
+            "# TYPE heartbeat_steps_per_second gauge",
+            "heartbeat_steps_per_second %f" % (steps / window),
+            "# TYPE heartbeat_successors_per_step gauge",
+            "heartbeat_successors_per_step %f" % ((self.successors - self._last_successors) / max(steps, 1)),
+            "# TYPE heartbeat_covered_blocks gauge",
+            "heartbeat_covered_blocks %d" % len(self.covered),
+            "# TYPE heartbeat_seconds_since_new_coverage gauge",
+            "heartbeat_seconds_since_new_coverage %f" % (now - self.last_new_coverage),
+            "# TYPE heartbeat_stash_states gauge",
+        ]
+        for name, states in simgr.stashes.items():
+            lines.append('heartbeat_stash_states{stash="%s"} %d' % (name, len(states)))
+        if self.process is not None:
+            lines.append("# TYPE heartbeat_rss_bytes gauge")
+            lines.append("heartbeat_rss_bytes %d" % self.process.memory_info().rss)
+
+        self._last_export = now
+        self._last_steps = self.steps
+        self._last_successors = self.successors
+        return "\n".join(lines) + "\n"
+
+    def export(self, simgr):
+        self.text = self.render(simgr)
+        if self.path is not None:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as fp:
+                fp.write(self.text)
+            os.replace(tmp_path, self.path)
+
+    def snapshot(self, simgr):
+        path = os.path.join(self.snapshot_dir, "heartbeat_snapshot_%d_%d.json" % (os.getpid(), int(time.time())))
+        dump = dict(steps=self.steps, stashes=dict())
+        for name, states in simgr.stashes.items():
+            dump["stashes"][name] = [self._describe(s) for s in states]
+        with open(path, "w") as fp:
+            json.dump(dump, fp, default=str)
+        l.info("Snapshot dumped to {}".format(path))
+        return path
+
+    @staticmethod
+    def _describe(state):
+        history = getattr(state, "history", None)
+        callstack = getattr(state, "callstack", None)
+        return dict(
+            addr=hex(state.addr) if hasattr(state, "addr") else None,
+            depth=history.depth if history is not None else None,
+            callstack=[hex(frame.func_addr) for frame in callstack] if callstack is not None else None,
+        )
+
+    def _request_snapshot(self, signum, frame):
+        self._snapshot_requested = True
+
+    def _serve(self, port):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.text.encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="HeartBeatMetrics", daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
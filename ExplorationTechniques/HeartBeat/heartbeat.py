@@ -46,8 +46,13 @@ def spw_cli():
 
 class HeartBeat(ExplorationTechnique):
 
-    def __init__(self, beat_interval=100):
+    def __init__(self, beat_interval=100, profiler=None, metrics=None, interactive=True):
         super(HeartBeat, self).__init__()
+        self.profiler = profiler
+        # a MetricsExporter, see HeartBeatMetrics.py
+        self.metrics = metrics
+        # unattended workers should not poll the stop file and block in ipdb
+        self.interactive = interactive
         self.stop_heart_beat_file = "/tmp/stop_heartbeat.txt"
         self.beat_interval = beat_interval
         self.beat_cnt = 0
@@ -60,12 +65,16 @@ class HeartBeat(ExplorationTechnique):
         succs = simgr.successors(state, **kwargs)
         self.beat_cnt += 1
         self.steps_cnt += 1
+        if self.metrics is not None:
+            self.metrics.record(simgr, state, succs.flat_successors)
         if self.beat_cnt == self.beat_interval:
             l.info("Exploration is alive <3. Step {}".format(self.steps_cnt)) 
             l.info("    Succs are: {}".format(succs))
             l.info("    Simgr is: {}".format(simgr))
+            if self.profiler is not None:
+                l.info("    Hooks are:\n{}".format(self.profiler.summary()))
             self.beat_cnt = 0
-            if os.path.isfile(self.stop_heart_beat_file):
+            if self.interactive and os.path.isfile(self.stop_heart_beat_file):
                 l.info("HeartBeat stopped, need help? </3")
                 
                 global CURR_SIMGR
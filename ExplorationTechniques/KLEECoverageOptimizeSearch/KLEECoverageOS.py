@@ -1,12 +1,172 @@
+import heapq
 import logging
-import random
+import time
 from itertools import cycle
 
 from angr.exploration_techniques import ExplorationTechnique
+from BlockCache import BlockCache
+from CoverageMap import CoverageMap
+from WeightedSampler import StashIndex, WeightedSampler
 
 l = logging.getLogger('KLEECoverageOS')
 
 
+class MD2UIndex(object):
+    """
+    Minimum distance (in instructions) from every CFG node to the closest uncovered node.
+
+    Distances are computed once with a reverse Dijkstra seeded from the uncovered nodes
+    and then maintained incrementally: covering a node only re-settles the predecessors
+    whose shortest path went through it. A node's own instructions are part of its
+    distance, so a covered node is never at distance 0.
+
+    Intra-procedural distances follow Boring/Call/FakeRet edges. To take the call stack
+    into account, the distance from every node to a return site of its function is also
+    kept, so a state deep in a callee can reach uncovered code in its callers through the
+    return addresses on its stack.
+    """
+
+    def __init__(self, cfg, covered=(), max_dist=10000, default=10, blocks=None):
+        self.cfg = cfg
+        self.blocks = blocks
+        self.max_dist = max_dist
+        self.default = default
+        self.graph = cfg.model.graph
+        self.weight = {}
+        self.uncovered = set()
+        self.dist = {}
+        self.ret_dist = {}
+        self._nodes = {}
+
+        for node in self.graph.nodes:
+            self.weight[node] = self._node_weight(node)
+            self.uncovered.add(node)
+        for addr in covered:
+            node = self.node(addr)
+            if node is not None:
+                self.uncovered.discard(node)
+
+        self._build_ret_dist()
+        self.build()
+
+    def node(self, addr):
+        try:
+            return self._nodes[addr]
+        except KeyError:
+            node = self.cfg.model.get_any_node(addr, anyaddr=True)
+            self._nodes[addr] = node
+            return node
+
+    def build(self):
+        """
+        Full reverse Dijkstra from the uncovered set.
+        """
+        self.dist = dict.fromkeys(self.graph.nodes, float('inf'))
+        heap = []
+        for node in self.uncovered:
+            self.dist[node] = 0
+            heap.append((0, id(node), node))
+        heapq.heapify(heap)
+        self._settle(heap, lambda _: True)
+
+    def cover(self, addr):
+        """
+        Mark the node holding addr as covered and repair the distances that depended on it.
+        """
+        node = self.node(addr)
+        if node is None or node not in self.uncovered:
+            return
+        self.uncovered.discard(node)
+
+        # Collect the region whose shortest path went through the newly covered node.
+        affected = {node}
+        todo = [node]
+        while todo:
+            n = todo.pop()
+            for pred in self.graph.predecessors(n):
+                if pred in affected or pred in self.uncovered:
+                    continue
+                if self.dist[pred] == self.weight[pred] + self.dist[n]:
+                    affected.add(pred)
+                    todo.append(pred)
+
+        for n in affected:
+            self.dist[n] = float('inf')
+
+        # Re-seed the region from its unaffected successors and settle it again.
+        heap = []
+        for n in affected:
+            succ_dist = min((self.dist[s] for s in self.graph.successors(n) if s not in affected),
+                            default=float('inf'))
+            if succ_dist != float('inf'):
+                self.dist[n] = self.weight[n] + succ_dist
+                heap.append((self.dist[n], id(n), n))
+        heapq.heapify(heap)
+        self._settle(heap, lambda n: n in affected)
+
+    def md2u(self, state):
+        """
+        O(call stack depth) lookup of the distance to uncovered code for a state.
+        """
+        node = self.node(state.addr)
+        if node is None:
+            return self.default
+
+        best = self.dist[node]
+        to_ret = self.ret_dist.get(node, float('inf'))
+        for frame in state.callstack:
+            if to_ret >= best or not frame.ret_addr:
+                break
+            ret_node = self.node(frame.ret_addr)
+            if ret_node is None:
+                break
+            best = min(best, to_ret + self.dist[ret_node])
+            to_ret += self.ret_dist.get(ret_node, float('inf'))
+
+        return min(best, self.max_dist)
+
+    def _node_weight(self, node):
+        if self.blocks is None:
+            return max(1, node.block.instructions) if node.block else self.default
+        info = self.blocks.get(node.addr)
+        return max(1, info.instructions) if info.size and not info.hooked else self.default
+
+    def _settle(self, heap, allowed):
+        while heap:
+            d, _, n = heapq.heappop(heap)
+            if d > self.dist[n]:
+                continue
+            for pred in self.graph.predecessors(n):
+                if pred in self.uncovered or not allowed(pred):
+                    continue
+                nd = self.weight[pred] + d
+                if nd < self.dist[pred]:
+                    self.dist[pred] = nd
+                    heapq.heappush(heap, (nd, id(pred), pred))
+
+    def _build_ret_dist(self):
+        # Calls are skipped through their FakeRet edge: the callee returns by itself.
+        heap = []
+        for func in self.cfg.functions.values():
+            for block in func.ret_sites:
+                node = self.node(block.addr)
+                if node is not None and node in self.weight:
+                    self.ret_dist[node] = self.weight[node]
+                    heap.append((self.ret_dist[node], id(node), node))
+        heapq.heapify(heap)
+        while heap:
+            d, _, n = heapq.heappop(heap)
+            if d > self.ret_dist[n]:
+                continue
+            for pred, _, data in self.graph.in_edges(n, data=True):
+                if data.get('jumpkind') == 'Ijk_Call':
+                    continue
+                nd = self.weight[pred] + d
+                if nd < self.ret_dist.get(pred, float('inf')):
+                    self.ret_dist[pred] = nd
+                    heapq.heappush(heap, (nd, id(pred), pred))
+
+
 class KLEECoverageOptimizeSearch(ExplorationTechnique):
     """
     Coverage Optimize Search. https://hci.stanford.edu/cstr/reports/2008-03.pdf
@@ -34,82 +194,158 @@ class KLEECoverageOptimizeSearch(ExplorationTechnique):
     This is implemented as a Non-Uniform-Random-Search with interleaved heuristics:
         1. md2u: minimum distance to uncovered instruction
         2. covnew: recently covered new code
-    TODO: a time/instruction batch limit may be set (default to false, user-set)
+    The 'deferred' states are kept in one WeightedSampler per heuristic across steps, and the picked
+    state is swap-removed from the stash through a StashIndex.
+    A time/instruction batch limit may be set passing a TimeSlice (default to false, user-set)
+    Deferred states may be paged out to disk passing a SpillStash (default None).
+    The covered blocks are kept in a CoverageMap, which can be backed by a file shared by concurrent
+    explorations of the same binary and kept across runs (default: in memory, for this run only).
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, time_slice=None, cfg_cache=None, spill_stash=None, coverage_path=None, **kwargs):
+        """
+        :param time_slice:    A TimeSlice, the selected state runs until it is used up (default None).
+        :param cfg_cache:     A CFGCache to load the CFG from instead of recovering it (default None).
+        :param spill_stash:   A SpillStash paging out the 'deferred' states (default None).
+        :param coverage_path: File backing the coverage bitmap (default None, in memory only).
+        """
         super(KLEECoverageOptimizeSearch, self).__init__()
+        self.time_slice = time_slice
+        self.cfg_cache = cfg_cache
+        self.spill_stash = spill_stash
+        self.coverage_path = coverage_path
         self.heuristics = cycle(['md2u', 'covnew'])
+        self.samplers = {'md2u': WeightedSampler(), 'covnew': WeightedSampler()}
+        # positions in the 'deferred' stash of the sampled states
+        self.deferred_index = StashIndex()
         self.curr_heuristic = None
-        self.covered = set()
+        self.covered = None
         self.cfg = None
+        self.md2u = None
+        self.blocks = None
 
     def setup(self, simgr):
         super(KLEECoverageOptimizeSearch, self).setup(simgr)
-        self.cfg = simgr._project.analyses.CFGFast(base_state=simgr.one_active, fail_fast=True, normalize=True)
-        
+        cfg_kwargs = dict(base_state=simgr.one_active, fail_fast=True, normalize=True)
+        if self.cfg_cache is not None:
+            self.cfg = self.cfg_cache.CFGFast(simgr._project, **cfg_kwargs)
+        else:
+            self.cfg = simgr._project.analyses.CFGFast(**cfg_kwargs)
+        self.blocks = BlockCache.for_project(simgr._project)
+        if self.covered is None:
+            self.covered = CoverageMap(simgr._project, path=self.coverage_path)
+        self.md2u = MD2UIndex(self.cfg, covered=self.covered, blocks=self.blocks)
+
+    # rebuilt by setup/resumed when resuming from a Checkpointer
+    checkpoint_exclude = ('cfg', 'cfg_cache', 'blocks', 'md2u', 'samplers', 'deferred_index', 'spill_stash')
+
+    def resumed(self, simgr):
+        self.md2u = MD2UIndex(self.cfg, covered=self.covered, blocks=self.blocks)
+        self.defer(simgr.stashes['deferred'])
+
     def rank(self, s, reverse=False):
         k = -1 if reverse else 1
         return k * s.globals[self.curr_heuristic]
 
     def step(self, simgr, stash='active', **kwargs):
+        started = time.perf_counter()
         simgr = simgr.step(stash=stash, **kwargs)
+        step_time = time.perf_counter() - started
 
-        # if there's no branch: update globals and go on
-        if len(simgr.stashes[stash]) == 1:
-            self.update_globals(simgr.stashes[stash][0])
-            return simgr
+        for state in simgr.stashes[stash]:
+            self.update_globals(state)
 
-        # if there are no successors: SHARED CODE AFTER IF STMT
-        elif len(simgr.stashes[stash]) == 0:
-            pass
-
-        # if there is more than one successor: update globals, SHARED CODE AFTER IF STMT
-        elif len(simgr.stashes[stash]) > 1:
-            for state in simgr.stashes[stash]:
-                self.update_globals(state)
+        # if the selected state still has time left: go on with it
+        if self.keep_running(simgr.stashes[stash], step_time):
+            if len(simgr.stashes[stash]) > 1:
+                self.defer(simgr.stashes[stash][1:])
+                simgr.split(from_stash=stash, to_stash='deferred', limit=1)
+            self.page_out(simgr)
+            return simgr
 
         # change heuristic
         self.curr_heuristic = next(self.heuristics)
 
+        # blocks covered by the concurrent explorations sharing the coverage file
+        if self.coverage_path is not None:
+            for addr in self.covered.sync():
+                self.md2u.cover(addr)
+
         # weighted choice
+        self.defer(simgr.stashes[stash])
         simgr.move(from_stash=stash, to_stash='deferred')
-        n = random.uniform(0, sum([s.globals[self.curr_heuristic] for s in simgr.stashes['deferred']]))
-        for s in simgr.stashes['deferred']:
-            if n < s.globals[self.curr_heuristic]:
-                simgr.stashes['deferred'].remove(s)
-                simgr.stashes[stash] = [s]
-                l.debug(f'{"-" * 0x10}\nStatus:\t\t{simgr} --> active: {simgr.stashes[stash]} [{self.curr_heuristic} {s.globals[self.curr_heuristic]}]')
-                break
-            n = n - s.globals[self.curr_heuristic]
+        deferred = simgr.stashes['deferred']
+        sampler = self.samplers[self.curr_heuristic]
+        if len(sampler) < len(deferred):
+            # states other techniques put straight in 'deferred' are not in the samplers yet
+            self.defer([s for s in deferred if s not in sampler])
+        while len(sampler) or len(deferred):
+            if not len(sampler):
+                # every entry left was stale, sample whatever is still deferred
+                self.defer(deferred)
+            s = sampler.sample()
+            self.undefer(s)
+            if not self.deferred_index.remove(deferred, s):
+                # left 'deferred' without going through evict, now out of the samplers too
+                continue
+            if self.spill_stash is not None:
+                s = self.spill_stash.load(s)
+            simgr.stashes[stash] = [s]
+            l.debug(f'{"-" * 0x10}\nStatus:\t\t{simgr} --> active: {simgr.stashes[stash]} [{self.curr_heuristic} {s.globals[self.curr_heuristic]}]')
+            break
+
+        if self.time_slice is not None:
+            self.time_slice.reset()
 
+        self.page_out(simgr)
         return simgr
 
+    def page_out(self, simgr):
+        if self.spill_stash is None:
+            return
+        for state, stub in self.spill_stash.shrink(simgr.stashes['deferred'], self.deferred_index):
+            self.deferred_index.replace(state, stub)
+            for sampler in self.samplers.values():
+                if state in sampler:
+                    sampler.add(stub, sampler.weight(state))
+                    sampler.remove(state)
+
+    def defer(self, states):
+        for heuristic, sampler in self.samplers.items():
+            for s in states:
+                sampler.add(s, s.globals[heuristic])
+        if self.spill_stash is not None:
+            self.spill_stash.defer(states)
+
+    def undefer(self, state):
+        for sampler in self.samplers.values():
+            sampler.remove(state)
+
+    def evict(self, states):
+        # shed states would keep their weight, and be sampled, until they are drawn
+        for s in states:
+            self.undefer(s)
+
+    def keep_running(self, states, step_time):
+        # no successors: always pick a new state
+        if not states:
+            return False
+        # no time slice: go on only if there's no branch
+        if self.time_slice is None:
+            return len(states) == 1
+        return not self.time_slice.charge(states[0], len(states), step_time)
+
     def update_globals(self, state):
         # if new, update covered blocks, set insns since new code to 0
         if state.addr not in self.covered:
             self.covered.add(state.addr)
+            self.md2u.cover(state.addr)
             state.globals['insns_since_new'] = 0
         # if not new: update insns since new code
         else:
-            state.globals['insns_since_new'] = state.globals.get('insns_since_new', 0) + state.block().instructions
+            state.globals['insns_since_new'] = state.globals.get('insns_since_new', 0) + self.blocks.get(state.addr).instructions
 
         state.globals['covnew'] = 1. / max(1, state.globals['insns_since_new'] - 1000)
         state.globals['covnew'] *= state.globals['covnew']
-        state.globals['md2u'] = 1. / min(self.get_md2u(state.addr), 10000) or 1
+        state.globals['md2u'] = 1. / max(1, self.md2u.md2u(state))
         state.globals['md2u'] *= state.globals['md2u']
-
-    def get_md2u(self, addr, iter=50):
-        if iter == 0:
-            return float('inf')
-
-        if addr not in self.covered:
-            return 0
-
-        node = self.cfg.model.get_any_node(addr, anyaddr=True)
-        md2u = float('inf')
-
-        for succ in set(node.successors):
-            md2u = min(md2u, self.get_md2u(succ, iter=iter - 1))
-
-        return md2u + node.block.instructions if node.block else 10
\ No newline at end of file
@@ -1,11 +1,152 @@
 import logging
 import random
+import time
 
 from angr.exploration_techniques import ExplorationTechnique
+from WeightedSampler import StashIndex
 
 l = logging.getLogger('KLEERandomSearch')
 
 
+class ForkNode(object):
+    __slots__ = ('parent', 'children', 'state')
+
+    def __init__(self, parent=None, state=None):
+        self.parent = parent
+        self.children = []
+        # only leaves hold a state
+        self.state = state
+
+
+class ForkTree(object):
+    """
+    Binary (n-ary, for indirect jumps) tree of the forks that generated the live states.
+
+    Leaves map to live states and internal nodes to places where execution forked.
+    Straight-line steps reuse the same leaf, dead leaves are pruned together with the
+    subtrees they leave empty and internal nodes left with a single child are collapsed,
+    so the depth of the tree is bounded by the number of forks the live states went through.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.leaves = dict()
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __contains__(self, state):
+        return id(state) in self.leaves
+
+    def add(self, state):
+        """
+        Add a state with no known parent as a child of the root.
+        """
+        leaf = ForkNode(state=state)
+        self.leaves[id(state)] = leaf
+        if self.root is None:
+            self.root = leaf
+            return
+        if self.root.state is not None:
+            old_root = self.root
+            self.root = ForkNode()
+            old_root.parent = self.root
+            self.root.children.append(old_root)
+        leaf.parent = self.root
+        self.root.children.append(leaf)
+
+    def fork(self, state, successors):
+        """
+        Replace the leaf of a stepped state with its successors.
+        """
+        leaf = self.leaves.pop(id(state), None)
+        if leaf is None:
+            for succ in successors:
+                self.add(succ)
+        elif not successors:
+            self._prune(leaf)
+        elif len(successors) == 1:
+            leaf.state = successors[0]
+            self.leaves[id(successors[0])] = leaf
+        else:
+            leaf.state = None
+            for succ in successors:
+                child = ForkNode(parent=leaf, state=succ)
+                leaf.children.append(child)
+                self.leaves[id(succ)] = child
+
+    def replace(self, state, other):
+        """
+        Let other take the leaf of state, i.e. a SpilledState stub and the state it stands for.
+        """
+        leaf = self.leaves.pop(id(state), None)
+        if leaf is not None:
+            leaf.state = other
+            self.leaves[id(other)] = leaf
+
+    def remove(self, state):
+        leaf = self.leaves.pop(id(state), None)
+        if leaf is not None:
+            self._prune(leaf)
+
+    def reindex(self):
+        """
+        Rebuild the leaves of a tree whose states changed identity, i.e. unpickled by a Checkpointer.
+        """
+        self.leaves = dict()
+        todo = [self.root] if self.root is not None else []
+        while todo:
+            node = todo.pop()
+            if node.state is not None:
+                self.leaves[id(node.state)] = node
+            todo.extend(node.children)
+
+    def select(self, rng=random):
+        """
+        Walk down from the root picking a random child at every fork, O(depth).
+        """
+        node = self.root
+        if node is None:
+            return None
+        while node.state is None:
+            node = rng.choice(node.children)
+        return node.state
+
+    def probability(self, state):
+        """
+        Probability of state being selected, O(depth).
+        """
+        node = self.leaves.get(id(state))
+        if node is None:
+            return 0.
+        p = 1.
+        while node.parent is not None:
+            p /= len(node.parent.children)
+            node = node.parent
+        return p
+
+    def _prune(self, node):
+        parent = node.parent
+        while parent is not None:
+            parent.children.remove(node)
+            if len(parent.children) > 1:
+                return
+            if len(parent.children) == 1:
+                self._collapse(parent)
+                return
+            node, parent = parent, parent.parent
+        self.root = None
+
+    def _collapse(self, node):
+        child = node.children[0]
+        child.parent = node.parent
+        if node.parent is None:
+            self.root = child
+        else:
+            siblings = node.parent.children
+            siblings[siblings.index(node)] = child
+
+
 class KLEERandomSearch(ExplorationTechnique):
     """
     Random path selection. https://hci.stanford.edu/cstr/reports/2008-03.pdf
@@ -17,49 +158,113 @@ class KLEERandomSearch(ExplorationTechnique):
     is reached the set of processes in each subtree will have equal probability of being selected,
     regardless of their size.
 
-    This is implemented as a Non-Uniform-Random-Search where child nodes inherit parent weight, divided by the number
-    of siblings
+    The tree is a ForkTree held by the technique. States that other techniques move out of
+    'deferred' are dropped from the tree lazily, when they get selected. The selected state is
+    swap-removed from 'deferred' through a StashIndex.
+    A time/instruction batch limit may be set passing a TimeSlice (default to false, user-set)
+    Deferred states may be paged out to disk passing a SpillStash (default None).
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, time_slice=None, spill_stash=None, **kwargs):
+        """
+        :param time_slice:  A TimeSlice, the selected state runs until it is used up (default None).
+        :param spill_stash: A SpillStash paging out the 'deferred' states (default None).
+        """
         super(KLEERandomSearch, self).__init__()
-    
-    @staticmethod
-    def rank(s, reverse=False):
+        self.time_slice = time_slice
+        self.spill_stash = spill_stash
+        self.tree = ForkTree()
+        # positions in the 'deferred' stash of the selected states
+        self.deferred_index = StashIndex()
+
+    def setup(self, simgr):
+        super(KLEERandomSearch, self).setup(simgr)
+        for s in simgr.stashes['active']:
+            self.tree.add(s)
+
+    # keyed by id(), rebuilt on the first selection after resuming from a Checkpointer,
+    # and the spill stash of the fresh technique pages the resumed states out
+    checkpoint_exclude = ('deferred_index', 'spill_stash')
+
+    def resumed(self, simgr):
+        # leaves are keyed by id(), stale once unpickled
+        self.tree.reindex()
+        # the tree may not have been checkpointed (i.e., too deep to pickle)
+        for s in simgr.stashes['active'] + simgr.stashes['deferred']:
+            if s not in self.tree:
+                self.tree.add(s)
+        self.defer(simgr.stashes['deferred'])
+
+    def rank(self, s, reverse=False):
         k = -1 if reverse else 1
-        return k * s.globals['weight']
-        
-    def step(self, simgr, stash='active', **kwargs):
-        simgr = simgr.step(stash=stash, **kwargs)
-        print(simgr.active)
+        return k * self.tree.probability(s)
 
-        # if there's no branch just go on
-        if len(simgr.stashes[stash]) == 1:
-            return simgr
+    def successors(self, simgr, state, **kwargs):
+        succs = simgr.successors(state, **kwargs)
+        # update binary tree
+        self.tree.fork(state, succs.flat_successors)
+        return succs
 
-        # if we there are no successors randomly pick a new path
-        elif len(simgr.stashes[stash]) == 0:
-            pass  # weighted choice code is always executed before returning
+    def step(self, simgr, stash='active', **kwargs):
+        started = time.perf_counter()
+        simgr = simgr.step(stash=stash, **kwargs)
+        step_time = time.perf_counter() - started
 
-        # if there is more than one successor update the binary tree and randomly pick a new path
-        elif len(simgr.stashes[stash]) > 1:
+        if len(simgr.stashes[stash]) > 1:
             l.debug(f'{"-" * 0x10}\nStatus:\t\t{simgr} --> active: {simgr.stashes[stash]}')
-            # update binary tree
-            for s in simgr.stashes[stash]:
-                s.globals['weight'] = s.globals.get('weight', 1) / len(simgr.stashes[stash])
-            pass  # weighted choice code is always executed before returning
+
+        # if the selected state still has time left just go on
+        if self.keep_running(simgr.stashes[stash], step_time):
+            if len(simgr.stashes[stash]) > 1:
+                self.defer(simgr.stashes[stash][1:])
+                simgr.split(from_stash=stash, to_stash='deferred', limit=1)
+            self.page_out(simgr)
+            return simgr
 
         # randomly pick new path
+        self.defer(simgr.stashes[stash])
         simgr.move(from_stash=stash, to_stash='deferred')
-        if max([s.globals['weight'] for s in simgr.stashes['deferred']]) < 0.1:
-            for s in simgr.stashes['deferred']:
-                s.globals['weight'] *= 10
-        n = random.uniform(0, sum([s.globals['weight'] for s in simgr.stashes['deferred']]))
-        for s in simgr.stashes['deferred']:
-            if n < s.globals['weight']:
-                simgr.stashes['deferred'].remove(s)
-                simgr.stashes[stash] = [s]
-                break
-            n = n - s.globals['weight']
-
-        return simgr
\ No newline at end of file
+        while len(self.tree):
+            s = self.tree.select()
+            if not self.deferred_index.remove(simgr.stashes['deferred'], s):
+                # a leaf whose state left 'deferred' without going through evict: prune it now
+                self.tree.remove(s)
+                continue
+            if self.spill_stash is not None:
+                loaded = self.spill_stash.load(s)
+                self.tree.replace(s, loaded)
+                s = loaded
+            simgr.stashes[stash] = [s]
+            break
+
+        if self.time_slice is not None:
+            self.time_slice.reset()
+
+        self.page_out(simgr)
+        return simgr
+
+    def page_out(self, simgr):
+        if self.spill_stash is None:
+            return
+        for state, stub in self.spill_stash.shrink(simgr.stashes['deferred'], self.deferred_index):
+            self.tree.replace(state, stub)
+            self.deferred_index.replace(state, stub)
+
+    def defer(self, states):
+        # the leaves are already in the tree, the spill stash pages out the oldest deferred states
+        if self.spill_stash is not None:
+            self.spill_stash.defer(states)
+
+    def evict(self, states):
+        # prune the leaves of the shed states, so that select does not walk down to them
+        for s in states:
+            self.tree.remove(s)
+
+    def keep_running(self, states, step_time):
+        # if we there are no successors randomly pick a new path
+        if not states:
+            return False
+        # if there's no time slice just go on when there's no branch
+        if self.time_slice is None:
+            return len(states) == 1
+        return not self.time_slice.charge(states[0], len(states), step_time)
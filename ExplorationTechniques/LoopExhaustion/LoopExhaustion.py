@@ -1,14 +1,106 @@
 
 # https://raw.githubusercontent.com/ucsb-seclab/syml/main/syml/exploration/exploration_techniques/literature/aeg_loop_exhaustion.py
 
+import heapq
 import logging
+from itertools import count
 
 import angr
 from angr.exploration_techniques import ExplorationTechnique
 
+from WeightedSampler import StashIndex
+
 l = logging.getLogger('LoopExhaustion')
 
 
+class DeferredHeap(object):
+    """
+    Max-heap of the 'deferred' states keyed by their loop progress (see AEGLoopExhaustion.rank).
+
+    Deferred states are not stepped, so their score is computed once when they are pushed, or
+    when attach finds them in the stash. Where they sit in the stash list is a StashIndex's job,
+    the heap only holds (score, order, state) entries: the entry of a state that left the stash
+    is cleared, and cleared entries are skipped when they reach the top.
+    """
+
+    def __init__(self, score):
+        self.score = score
+        self.heap = []
+        self.entries = dict()
+        self.index = StashIndex()
+        self._seq = count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def attach(self, states):
+        """
+        Follow the stash list: score the states deferred by other techniques, forget the ones they took away.
+
+        :return: The states that were not in the heap.
+        """
+        reindexed, new = self.index.sync(states)
+        new = [s for s in new if id(s) not in self.entries]
+        for s in new:
+            self._add(s, self.score(s))
+        if reindexed:
+            for key in [key for key in self.entries if key not in self.index.positions]:
+                self.entries.pop(key)[2] = None
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [entry for entry in self.heap if entry[2] is not None]
+                heapq.heapify(self.heap)
+        return new
+
+    def push(self, states, state, score=None):
+        score = self.score(state) if score is None else score
+        self._add(state, score)
+        self.index.append(states, state)
+
+    def pop(self, states):
+        """
+        Remove and return the deferred state with the highest score, O(log n) amortized.
+        """
+        while self.heap:
+            state = heapq.heappop(self.heap)[2]
+            if state is None:
+                continue
+            del self.entries[id(state)]
+            if self.index.remove(states, state):
+                return state
+            # not in the stash anymore, the stale entry of a state taken away since the last attach
+        return None
+
+    def replace(self, state, other):
+        """
+        Let other take the place of state, i.e. a SpilledState stub and the state it stands for.
+        """
+        entry = self.entries.pop(id(state), None)
+        if entry is not None:
+            entry[2] = other
+            self.entries[id(other)] = entry
+        self.index.replace(state, other)
+
+    def remove(self, states, state):
+        self.discard(state)
+        self.index.remove(states, state)
+
+    def discard(self, state):
+        """
+        Forget a state that another technique took out of the stash.
+        """
+        entry = self.entries.pop(id(state), None)
+        if entry is not None:
+            entry[2] = None
+
+    def _add(self, state, score):
+        entry = [-score, next(self._seq), state]
+        old = self.entries.get(id(state))
+        if old is not None:
+            old[2] = None
+        self.entries[id(state)] = entry
+        heapq.heappush(self.heap, entry)
+
+
 class AEGLoopExhaustion(ExplorationTechnique):
     """
     Loop Exhaustion. http://security.ece.cmu.edu/aeg/aeg-current.pdf
@@ -25,20 +117,51 @@ class AEGLoopExhaustion(ExplorationTechnique):
     1) we use preconditioned symbolic execution along with pruning to reduce the number of interpreters or
     2) we give higher priority to only one interpreter that tries to fully exhaust the loop,
     while all other interpreters exploring the same loop have the lowest possible priority.
+
+    The 'deferred' states are kept in a DeferredHeap keyed by their loop progress, so picking
+    the next candidate costs O(log n) instead of sorting the whole stash.
+    Deferred states may be paged out to disk passing a SpillStash (default None), their stubs
+    keep the loop trip counts so they are ranked without being paged back in.
+
+    The pruning heuristic is opt-in (merge=True): every merge_interval steps the deferred states
+    parked at the head of a loop they are in are grouped by address and call stack, and each group
+    is merged into a single state. The most advanced state of every group is never merged, so the
+    deepest-iteration path is not lost.
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, spill_stash=None, merge=False, merge_interval=10, max_merge=8, max_constraints=200, **kwargs):
+        """
+        :param spill_stash:     A SpillStash paging out the 'deferred' states (default None).
+        :param merge:           Merge the deferred states parked at the same loop head (default False).
+        :param merge_interval:  Steps between two merge passes.
+        :param max_merge:       States merged together at most.
+        :param max_constraints: States with more constraints than this are not merged.
+        """
         super(AEGLoopExhaustion, self).__init__()
         self.top_count = 0
+        self.spill_stash = spill_stash
+        self.deferred = DeferredHeap(self.rank)
+        self.merge = merge
+        self.merge_interval = merge_interval
+        self.max_merge = max_merge
+        self.max_constraints = max_constraints
+        self.steps = 0
+        self.merged = 0
 
     def setup(self, simgr):
         super(AEGLoopExhaustion, self).setup(simgr=simgr)
-        simgr.stashes['active'][0].globals['visits'] = dict()
+        # a resumed state keeps its loop data
+        if not simgr.stashes['active'][0].has_plugin('loop_data'):
+            simgr.stashes['active'][0].globals['visits'] = dict()
+            simgr.stashes['active'][0].register_plugin('loop_data', angr.state_plugins.SimStateLoopData())
 
         # setup LoopSeer
-        simgr.stashes['active'][0].register_plugin('loop_data', angr.state_plugins.SimStateLoopData())
         simgr.use_technique(angr.exploration_techniques.LoopSeer(bound=10000))
 
+    # keyed by id(), rebuilt from the stash by the first step after resuming from a Checkpointer,
+    # which also hands the resumed states to the spill stash of the fresh technique
+    checkpoint_exclude = ('deferred', 'spill_stash')
+
     @staticmethod
     def rank(s, reverse=False):
         k = -1 if reverse else 1
@@ -46,36 +169,98 @@ class AEGLoopExhaustion(ExplorationTechnique):
 
     def step(self, simgr, stash='active', **kwargs):
         simgr = simgr.step(stash=stash, **kwargs)
+        deferred = simgr.stashes['deferred']
+        new = self.deferred.attach(deferred)
+        if self.spill_stash is not None:
+            self.spill_stash.defer(new)
 
         if len(simgr.stashes[stash]) == 1:
             new_count = self.rank(simgr.stashes[stash][0])
-            if new_count > self.top_count or len(simgr.stashes['deferred']) == 0:
+            if new_count > self.top_count or len(self.deferred) == 0:
                 #l.debug(f'looping!')
                 self.top_count = new_count
             else:
-                #l.debug(f'exhausted or new loop!')  # \t {simgr.stashes[stash][0].loop_data.back_edge_trip_counts}')
-                simgr.move(from_stash=stash, to_stash='deferred')
-                simgr.split(from_stash='deferred', to_stash=stash, state_ranker=self.rank,
-                            limit=len(simgr.deferred) - 1)
+                #l.debug(f'exhausted or new loop!')
+                self.defer(deferred, simgr.stashes[stash][0], new_count)
+                simgr.stashes[stash] = [self.pop_deferred(deferred)]
                 self.top_count = self.rank(simgr.stashes[stash][0])
 
         elif len(simgr.stashes[stash]) == 0:
             #l.debug('exhausted?')
-            simgr.split(from_stash='deferred', to_stash=stash, state_ranker=self.rank, limit=len(simgr.deferred) - 1)
-            self.top_count = self.rank(simgr.stashes[stash][0])
+            if len(self.deferred):
+                simgr.stashes[stash] = [self.pop_deferred(deferred)]
+                self.top_count = self.rank(simgr.stashes[stash][0])
 
         else:
+            # siblings in different loop iterations: only the most advanced one goes on
             counts = simgr.stashes[stash][0].loop_data.back_edge_trip_counts
-            for s in simgr.stashes[stash][1:]:
-                if s.loop_data.back_edge_trip_counts != counts:
-                    simgr.split(from_stash=stash, to_stash='deferred', state_ranker=lambda s: self.rank(s, reverse=True),
-                                limit=1)
-                    self.top_count = self.rank(simgr.stashes[stash][0])
-
-                    l.debug(f'{"-" * 0x10}\nStatus:\t\t{simgr} --> active: {simgr.stashes[stash]}')
-                    break
+            if any(s.loop_data.back_edge_trip_counts != counts for s in simgr.stashes[stash][1:]):
+                scores = [self.rank(s) for s in simgr.stashes[stash]]
+                top = scores.index(max(scores))
+                for i, s in enumerate(simgr.stashes[stash]):
+                    if i != top:
+                        self.defer(deferred, s, scores[i])
+                simgr.stashes[stash] = [simgr.stashes[stash][top]]
+                self.top_count = scores[top]
+
+                l.debug(f'{"-" * 0x10}\nStatus:\t\t{simgr} --> active: {simgr.stashes[stash]}')
             else:
                 #l.debug('one more step..and let\'s see what happens..')
                 pass
 
-        return simgr
\ No newline at end of file
+        self.steps += 1
+        if self.merge and self.steps % self.merge_interval == 0:
+            self.merge_loop_heads(deferred)
+
+        if self.spill_stash is not None:
+            simgr.stashes[stash] = self.spill_stash.page_in(simgr.stashes[stash])
+            for state, stub in self.spill_stash.shrink(deferred, self.deferred.index):
+                self.deferred.replace(state, stub)
+
+        return simgr
+
+    def merge_loop_heads(self, deferred):
+        groups = dict()
+        for s in deferred:
+            # paged out states are not merged
+            if not isinstance(s, angr.SimState) or len(s.solver.constraints) > self.max_constraints:
+                continue
+            if s.addr not in {loop[0].entry.addr for loop in s.loop_data.current_loop}:
+                continue
+            key = (s.addr, tuple((frame.func_addr, frame.ret_addr) for frame in s.callstack))
+            groups.setdefault(key, []).append(s)
+
+        for group in groups.values():
+            if len(group) < 3:
+                continue
+            group.sort(key=self.rank, reverse=True)
+            # the most advanced state goes on by itself
+            to_merge = group[1:1 + self.max_merge]
+            try:
+                merged, _, merging_occurred = to_merge[0].merge(*to_merge[1:])
+            except Exception as e:
+                l.warning(f'Could not merge {len(to_merge)} states at {to_merge[0].addr:#x}: {e}')
+                continue
+            if not merging_occurred:
+                continue
+            for s in to_merge:
+                self.deferred.remove(deferred, s)
+            self.defer(deferred, merged)
+            self.merged += len(to_merge) - 1
+            l.debug(f'merged {len(to_merge)} states at {merged.addr:#x}')
+
+    def evict(self, states):
+        # clear the heap entries of the shed states, attach only does it when the stash list is rebuilt
+        for s in states:
+            self.deferred.discard(s)
+
+    def defer(self, deferred, state, score=None):
+        self.deferred.push(deferred, state, score)
+        if self.spill_stash is not None:
+            self.spill_stash.defer([state])
+
+    def pop_deferred(self, deferred):
+        s = self.deferred.pop(deferred)
+        if self.spill_stash is not None:
+            s = self.spill_stash.load(s)
+        return s
@@ -1,29 +1,169 @@
+import heapq
+import logging
 import os
+import threading
+
 import psutil
 from angr.exploration_techniques import ExplorationTechnique
 
+l = logging.getLogger('MemLimiter')
+
+CGROUP_LIMITS = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+TERMINAL_STASHES = ('deadended', 'avoid', 'found')
+
+OK, SOFT, HARD = range(3)
+
+
+def cgroup_limit():
+    # memory limit of the cgroup we run in (in GiB), None when there is none
+    for path in CGROUP_LIMITS:
+        try:
+            with open(path) as fp:
+                value = fp.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2 ** 60:
+            return int(value) / float(2 ** 30)
+    return None
+
+
+def evict(simgr, states):
+    # let the other techniques drop their references to the shed states
+    if not states:
+        return
+    for t in simgr._techniques:
+        if hasattr(t, 'evict'):
+            t.evict(states)
+
+
 class MemLimiter(ExplorationTechnique):
-    def __init__(self, max_mem, drop_errored):
+    '''
+    Memory governor. The resident memory of the process (and the cgroup limit, when there is one)
+    is sampled every `interval` seconds by a background thread, so stepping never waits for psutil.
+
+    Once the soft watermark is crossed the responses are graded, one per sample:
+    first the terminal stashes are dropped, then, if memory is still above the soft watermark,
+    the deferred states with the lowest priority (according to `ranker`) are shed.
+    Each response happens once per crossing: the resident memory hardly shrinks once states are
+    freed, so they are re-armed only after it falls below the low watermark.
+    When the hard watermark is crossed the exploration is stopped, moving the active and
+    deferred states to 'out_of_memory'.
+
+    Shed states are handed to the `evict(states)` method of every technique that has one, so that
+    the search structures holding them (samplers, fork trees, heaps) let them go.
+    '''
+    def __init__(self, max_mem, drop_errored, soft_mem=None, interval=1., ranker=None, shed_ratio=0.5, low_mem=None):
+        '''
+        :param max_mem:      Hard watermark in GiB, lowered to the cgroup limit if there is one.
+        :param drop_errored: Drop the errored states together with the terminal stashes.
+        :param soft_mem:     Soft watermark in GiB (default 80% of the hard one).
+        :param interval:     Seconds between two samples.
+        :param ranker:       state -> priority, the lowest priority deferred states are shed first
+                             (default: the oldest deferred states are shed first).
+        :param shed_ratio:   Fraction of the deferred states shed every time.
+        :param low_mem:      Low watermark in GiB re-arming the responses (default 90% of the soft one).
+        '''
         super(MemLimiter, self).__init__()
-        self.max_mem = max_mem
+        limit = cgroup_limit()
+        self.max_mem = min(max_mem, limit) if limit is not None else max_mem
+        self.soft_mem = soft_mem if soft_mem is not None else 0.8 * self.max_mem
+        if self.soft_mem >= self.max_mem:
+            # i.e., a soft watermark above a lower cgroup limit
+            l.warning("Soft watermark %.2f GiB not below the hard one, lowered to 80%% of %.2f GiB"
+                      % (self.soft_mem, self.max_mem))
+            self.soft_mem = 0.8 * self.max_mem
+        assert self.soft_mem < self.max_mem
+        self.low_mem = low_mem if low_mem is not None else 0.9 * self.soft_mem
+        if self.low_mem >= self.soft_mem:
+            l.warning("Low watermark %.2f GiB not below the soft one, lowered to 90%% of %.2f GiB"
+                      % (self.low_mem, self.soft_mem))
+            self.low_mem = 0.9 * self.soft_mem
         self.drop_errored = drop_errored
+        self.interval = interval
+        self.ranker = ranker
+        self.shed_ratio = shed_ratio
         self.process = psutil.Process(os.getpid())
 
+        # written by the sampler thread only
+        self.mem = 0.
+        self.level = OK
+        self.samples = 0
+
+        self._handled_sample = 0
+        self._dropped_terminal = False
+        self._shed = False
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def setup(self, simgr):
+        super(MemLimiter, self).setup(simgr)
+        self.sample()
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_loop, name='MemLimiter', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        self.mem = self.memory_usage_psutil
+        if psutil.virtual_memory().percent > 90 or self.mem >= self.max_mem:
+            self.level = HARD
+        elif self.mem >= self.soft_mem:
+            self.level = SOFT
+        else:
+            self.level = OK
+        self.samples += 1
+
     def step(self, simgr, stash='active', **kwargs):
-        if psutil.virtual_memory().percent > 90 or (self.max_mem - 1) < self.memory_usage_psutil:
-            simgr.move(from_stash='active', to_stash='out_of_memory')
-            simgr.move(from_stash='deferred', to_stash='out_of_memory')
+        # react once per sample
+        if self._handled_sample != self.samples:
+            self._handled_sample = self.samples
+            if self.level == HARD:
+                l.critical("Out of memory, stopping: %s" % self.report(simgr))
+                simgr.move(from_stash='active', to_stash='out_of_memory')
+                simgr.move(from_stash='deferred', to_stash='out_of_memory')
+            elif self.level == SOFT and not self._dropped_terminal:
+                l.warning("Soft memory limit reached, dropping terminal stashes: %s" % self.report(simgr))
+                self.drop_terminal(simgr)
+                self._dropped_terminal = True
+            elif self.level == SOFT and not self._shed:
+                l.warning("Soft memory limit reached, shedding deferred states: %s" % self.report(simgr))
+                self.shed_deferred(simgr)
+                self._shed = True
+            elif self.mem < self.low_mem:
+                self._dropped_terminal = self._shed = False
 
-        simgr.drop(stash='deadended')
-        simgr.drop(stash='avoid')
-        simgr.drop(stash='found')
+        return simgr.step(stash=stash, **kwargs)
+
+    def drop_terminal(self, simgr):
+        for st in TERMINAL_STASHES:
+            if hasattr(simgr, st):
+                simgr.drop(stash=st)
         if self.drop_errored:
             del simgr.errored[:]
 
-        return simgr.step(stash=stash)
+    def shed_deferred(self, simgr):
+        deferred = simgr.stashes['deferred']
+        n_keep = len(deferred) - int(len(deferred) * self.shed_ratio)
+        if self.ranker is None:
+            keep = deferred[len(deferred) - n_keep:]
+        else:
+            keep = heapq.nlargest(n_keep, deferred, key=self.ranker)
+        simgr.stashes['deferred'] = keep
+        kept = {id(s) for s in keep}
+        evict(simgr, [s for s in deferred if id(s) not in kept])
+
+    def report(self, simgr):
+        counts = ', '.join('%d %s' % (len(states), name) for name, states in simgr.stashes.items() if states)
+        return "%.2f/%.2f GiB RSS [%s]" % (self.mem, self.max_mem, counts)
 
     @property
     def memory_usage_psutil(self):
-        # return the memory usage in MB
-        mem = self.process.memory_info().vms / float(2 ** 30)
+        # return the resident memory usage in GiB
+        mem = self.process.memory_info().rss / float(2 ** 30)
         return mem
@@ -0,0 +1,288 @@
+import bisect
+import hashlib
+import logging
+import mmap
+import struct
+from array import array
+
+import networkx
+
+l = logging.getLogger("SimgrCompact")
+
+MAGIC = b"SVZCOMP2"
+# magic, number of super-nodes, number of columns
+HEADER = struct.Struct("<8sQQ")
+# name, typecode, offset, number of items
+COLUMN = struct.Struct("<16s8sQQ")
+
+HOOKED, TIMEOUT, FAKE_RET = 1, 2, 4
+
+# super-node columns, in preorder: the subtree of node i is [i, subtree_end[i])
+COLUMNS = (
+    ("parent", "q"),
+    ("subtree_end", "Q"),
+    ("depth", "I"),
+    ("steps", "I"),
+    ("first_addr", "Q"),
+    ("last_addr", "Q"),
+    ("addr_min", "Q"),
+    ("addr_max", "Q"),
+    ("jumpkinds", "Q"),
+    ("flags", "B"),
+    ("id_offset", "Q"),
+)
+
+
+def _addr(attrs):
+    try:
+        return int(attrs.get("state_addr", "0"), 16)
+    except (TypeError, ValueError):
+        return 0
+
+
+def id_hash(node_id):
+    # 64 bits of the node id, the key of the sorted id index of the file
+    return int.from_bytes(hashlib.blake2b(str(node_id).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def collapse_chains(G):
+    '''
+    Collapse the linear runs of G (a node with a single successor, which has a single predecessor)
+    into super-nodes.
+
+    :return: (chains, edges): the lists of the nodes of every chain, the first one is its head,
+             and the (tail chain, head chain) edges between the chains.
+    '''
+    def is_head(n):
+        if G.in_degree(n) != 1:
+            return True
+        pred = next(iter(G.predecessors(n)))
+        return G.out_degree(pred) != 1 or pred == n
+
+    chain_of = dict()
+    chains = []
+    for head in G.nodes:
+        if not is_head(head):
+            continue
+        chain = [head]
+        chain_of[head] = len(chains)
+        n = head
+        while G.out_degree(n) == 1:
+            succ = next(iter(G.successors(n)))
+            if succ in chain_of or is_head(succ):
+                break
+            chain.append(succ)
+            chain_of[succ] = len(chains)
+            n = succ
+        chains.append(chain)
+
+    # nodes on a cycle with no way in have no head, they get a chain each
+    for n in G.nodes:
+        if n not in chain_of:
+            chain_of[n] = len(chains)
+            chains.append([n])
+
+    edges = set()
+    for chain in chains:
+        for succ in G.successors(chain[-1]):
+            edges.add((chain_of[chain[-1]], chain_of[succ]))
+        # chains cut by a cycle
+        for n in chain[:-1]:
+            for succ in G.successors(n):
+                if chain_of[succ] != chain_of[n]:
+                    edges.add((chain_of[n], chain_of[succ]))
+    return chains, sorted(edges)
+
+
+def write_compact(G, path):
+    '''
+    Write the exploration graph of SimgrViz (or of load_graph) collapsed into super-nodes,
+    in a columnar binary file that CompactGraph reads lazily.
+    '''
+    chains, edges = collapse_chains(G)
+    children = [[] for _ in chains]
+    has_parent = [False] * len(chains)
+    for a, b in edges:
+        children[a].append(b)
+        has_parent[b] = True
+
+    # preorder layout, so that every subtree is a range of rows
+    order = []
+    parent = dict()
+    depth = dict()
+    end = dict()
+    seen = set()
+    roots = [c for c in range(len(chains)) if not has_parent[c]] + list(range(len(chains)))
+    for root in roots:
+        if root in seen:
+            continue
+        seen.add(root)
+        parent[root], depth[root] = -1, 0
+        stack = [(root, False)]
+        while stack:
+            c, done = stack.pop()
+            if done:
+                end[c] = len(order)
+                continue
+            order.append(c)
+            stack.append((c, True))
+            for child in reversed(children[c]):
+                # DAG edges past the first parent are not part of the tree layout
+                if child not in seen:
+                    seen.add(child)
+                    parent[child], depth[child] = c, depth[c] + 1
+                    stack.append((child, False))
+    row = {c: i for i, c in enumerate(order)}
+
+    jumpkinds = []
+    jumpkind_bit = dict()
+    cols = {name: array(typecode) for name, typecode in COLUMNS}
+    ids = bytearray()
+    for c in order:
+        chain = chains[c]
+        attrs = [G.nodes[n] for n in chain]
+        addrs = [_addr(a) for a in attrs]
+        mask = 0
+        flags = 0
+        for a in attrs:
+            jk = a.get("jumpkind")
+            if jk is not None:
+                if jk not in jumpkind_bit:
+                    jumpkind_bit[jk] = len(jumpkinds)
+                    jumpkinds.append(jk)
+                if jumpkind_bit[jk] < 64:
+                    mask |= 1 << jumpkind_bit[jk]
+            if a.get("hooked"):
+                flags |= HOOKED
+            if a.get("timeout"):
+                flags |= TIMEOUT
+            if a.get("call_followed") is False:
+                flags |= FAKE_RET
+        cols["parent"].append(row[parent[c]] if parent[c] != -1 else -1)
+        cols["subtree_end"].append(end[c])
+        cols["depth"].append(depth[c])
+        cols["steps"].append(len(chain))
+        cols["first_addr"].append(addrs[0])
+        cols["last_addr"].append(addrs[-1])
+        cols["addr_min"].append(min(addrs))
+        cols["addr_max"].append(max(addrs))
+        cols["jumpkinds"].append(mask)
+        cols["flags"].append(flags)
+        cols["id_offset"].append(len(ids))
+        ids += "\x00".join(str(n) for n in chain).encode("utf-8") + b"\n"
+
+    # (hash of a node id, row of its super-node), sorted, for find
+    index = sorted((id_hash(n), row[c]) for c in order for n in chains[c])
+    cols["index_hash"] = array("Q", (h for h, _ in index))
+    cols["index_row"] = array("Q", (r for _, r in index))
+
+    blobs = [(name, typecode, cols[name].tobytes(), len(cols[name]))
+             for name, typecode in COLUMNS + (("index_hash", "Q"), ("index_row", "Q"))]
+    blobs.append(("ids", "B", bytes(ids), len(ids)))
+    jk_blob = "\n".join(jumpkinds).encode("utf-8")
+    blobs.append(("jumpkind_names", "B", jk_blob, len(jk_blob)))
+
+    offset = HEADER.size + COLUMN.size * len(blobs)
+    with open(path, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, len(order), len(blobs)))
+        for name, typecode, data, n in blobs:
+            fp.write(COLUMN.pack(name.encode(), typecode.encode(), offset, n))
+            offset += len(data)
+        for _, _, data, _ in blobs:
+            fp.write(data)
+    l.info("{} nodes collapsed into {} super-nodes in {}".format(G.number_of_nodes(), len(order), path))
+    return len(order)
+
+
+class CompactGraph(object):
+    '''
+    Lazy reader of a write_compact file: the columns are memory-mapped and only the rows
+    that are asked for are decoded.
+    '''
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, n_columns = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a SimgrViz compact graph".format(path))
+        self.columns = dict()
+        for i in range(n_columns):
+            name, typecode, offset, n = COLUMN.unpack_from(self._mm, HEADER.size + i * COLUMN.size)
+            name, typecode = name.rstrip(b"\x00").decode(), typecode.rstrip(b"\x00").decode()
+            size = struct.calcsize(typecode)
+            self.columns[name] = memoryview(self._mm)[offset:offset + n * size].cast(typecode)
+        self.jumpkind_names = bytes(self.columns["jumpkind_names"]).decode("utf-8").split("\n")
+
+    def __len__(self):
+        return self.n
+
+    def roots(self):
+        parent = self.columns["parent"]
+        i = 0
+        while i < self.n:
+            if parent[i] == -1:
+                yield i
+            i = self.columns["subtree_end"][i] if parent[i] == -1 else i + 1
+
+    def ids(self, i):
+        ids = self.columns["ids"]
+        start = self.columns["id_offset"][i]
+        end = self.columns["id_offset"][i + 1] if i + 1 < self.n else len(ids)
+        return bytes(ids[start:end - 1]).decode("utf-8").split("\x00")
+
+    def node(self, i):
+        c = self.columns
+        mask = c["jumpkinds"][i]
+        return dict(
+            head=self.ids(i)[0],
+            steps=c["steps"][i],
+            depth=c["depth"][i],
+            first_addr=hex(c["first_addr"][i]),
+            last_addr=hex(c["last_addr"][i]),
+            addr_range=(hex(c["addr_min"][i]), hex(c["addr_max"][i])),
+            jumpkinds=[name for bit, name in enumerate(self.jumpkind_names) if bit < 64 and mask >> bit & 1],
+            hooked=bool(c["flags"][i] & HOOKED),
+            timeout=bool(c["flags"][i] & TIMEOUT),
+            fake_ret=bool(c["flags"][i] & FAKE_RET),
+        )
+
+    def find(self, node_id):
+        '''
+        Row of the super-node holding a node of the original graph, O(log n) through the id index.
+        '''
+        hashes = self.columns["index_hash"]
+        h = id_hash(node_id)
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            row = self.columns["index_row"][i]
+            if str(node_id) in self.ids(row):
+                return row
+            i += 1
+        return None
+
+    def subtree(self, root=0, max_depth=None):
+        '''
+        The super-nodes below root as a networkx.DiGraph, decoding only the rows of the subtree.
+        '''
+        G = networkx.DiGraph()
+        end = self.columns["subtree_end"][root]
+        depth = self.columns["depth"]
+        parent = self.columns["parent"]
+        base = depth[root]
+        i = root
+        while i < end:
+            if max_depth is not None and depth[i] - base > max_depth:
+                # skip the whole subtree
+                i = self.columns["subtree_end"][i]
+                continue
+            G.add_node(i, **self.node(i))
+            if i != root:
+                G.add_edge(parent[i], i)
+            i += 1
+        return G
+
+    def close(self):
+        for view in self.columns.values():
+            view.release()
+        self._mm.close()
+        self._fp.close()
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from collections import deque
+
+import networkx
+
+l = logging.getLogger("SimgrSink")
+
+
+class SimgrSink(object):
+    '''
+    Append-only log of the nodes and edges collected by SimgrViz.
+
+    Every record is one JSON line: ["n", node_id, attrs] or ["e", parent_id, node_id].
+    Attributes of a node can be spread over several records, the loader merges them in
+    order like networkx.DiGraph.add_node does. At most buffer_size records are kept in
+    memory, so a crash loses at most the last buffer and the log stays readable.
+
+    The log is truncated when opened: SimgrViz counters restart at "1" with every run, so
+    appending a second run would merge unrelated nodes under the same ids. Use append=True
+    only with ids that are unique across runs (i.e., SimgrViz(fingerprint=True)).
+    '''
+    def __init__(self, path, buffer_size=4096, append=False):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._fp = open(path, "a" if append else "w")
+
+    def add_node(self, node_id:str, **attrs):
+        self._write(["n", node_id, attrs])
+
+    def add_edge(self, parent_id:str, node_id:str):
+        self._write(["e", parent_id, node_id])
+
+    def _write(self, record):
+        self._buffer.append(json.dumps(record, default=str))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._fp.write("\n".join(self._buffer) + "\n")
+            self._buffer = []
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        if not self._fp.closed:
+            self.flush()
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _records(path):
+    with open(path) as fp:
+        for lineno, line in enumerate(fp, 1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line of a log whose process died while writing
+                l.warning("Skipping truncated record at {}:{}".format(path, lineno))
+
+
+def load_graph(path, root=None, max_depth=None, node_filter=None):
+    '''
+    Rebuild the exploration graph from a SimgrSink log.
+
+    :param root:        Only keep the subtree rooted at this node id.
+    :param max_depth:   Only keep nodes up to this distance from root.
+    :param node_filter: Only keep nodes for which node_filter(node_id, attrs) is True.
+    :return:            A networkx.DiGraph like SimgrViz._simgrG.
+    '''
+    G = networkx.DiGraph()
+    for record in _records(path):
+        if record[0] == "n":
+            G.add_node(record[1], **record[2])
+        elif record[0] == "e":
+            G.add_edge(record[1], record[2])
+
+    if root is not None:
+        keep = {root}
+        todo = deque([(root, 0)])
+        while todo:
+            node, depth = todo.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for succ in G.successors(node):
+                if succ not in keep:
+                    keep.add(succ)
+                    todo.append((succ, depth + 1))
+        G = G.subgraph(keep).copy()
+
+    if node_filter is not None:
+        G = G.subgraph([n for n, attrs in G.nodes(data=True) if node_filter(n, attrs)]).copy()
+
+    return G
@@ -11,6 +11,8 @@ from typing import List, Set, Dict, Tuple, Optional
 from angr.exploration_techniques import ExplorationTechnique
 from angr import SimState
 from networkx.drawing.nx_agraph import write_dot
+from BlockCache import BlockCache
+from SimgrCompact import write_compact
 
 from shutil import which
 
@@ -25,11 +27,26 @@ class SimgrViz(ExplorationTechnique):
     When plugging this Exploration technique we collect information
     regarding the SimStates generated by the Simgr.
     This is a DEBUG ONLY technique that should never be used in production.
+
+    States are identified by a per-technique counter, the (expensive) content fingerprint
+    of a state is only computed by get_state_hash, or for every state when fingerprint=True.
+
+    Nodes and edges can also be streamed to a SimgrSink while stepping (see SimgrSink.py),
+    with keep_graph=False the graph is not kept in memory at all.
+
+    export_compact writes the graph with its linear runs collapsed, see SimgrCompact.py.
     '''
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, fingerprint=False, sink=None, keep_graph=True, cfg_cache=None):
         super(SimgrViz, self).__init__()
         self._simgrG = networkx.DiGraph()
         self.cfg = cfg
+        # Used to recover the CFG (i.e., the function names) when no cfg is given
+        self.cfg_cache = cfg_cache
+        self.sink = sink
+        self.keep_graph = keep_graph
+        self.blocks = None
+        self.fingerprint = fingerprint
+        self._state_cnt = 0
         # Boolean guard to understand if this is the initial state or not.
         self._start = True
         self._salt = 0
@@ -46,13 +63,31 @@ class SimgrViz(ExplorationTechnique):
 
         self.last_seen_id = None
 
+    # rebuilt by setup when resuming from a Checkpointer
+    checkpoint_exclude = ('cfg', 'cfg_cache', 'blocks', 'sink')
+
     def setup(self, simgr):
+        if self.cfg is None and self.cfg_cache is not None:
+            self.cfg = self.cfg_cache.CFGFast(simgr._project, normalize=True)
         for state in simgr.stashes['active']:
+            # a state resumed from a Checkpointer keeps its place in the graph
+            if "predecessor" in state.globals:
+                continue
             state.globals["predecessor"] = None
             state.globals["path_exploration_id"] = self._path_exploration_id
         self._path_exploration_id += 1
         return
 
+    def get_state_id(self, state):
+        if self.fingerprint:
+            state_id = self.get_state_hash(state)
+        else:
+            self._state_cnt += 1
+            state_id = str(self._state_cnt)
+        # Store the signature into the state.
+        state.globals["state_signature"] = state_id
+        return state_id
+
     def get_state_hash(self, state):
         reg_values = []
         for r in state.project.arch.register_list:
@@ -75,64 +110,82 @@ class SimgrViz(ExplorationTechnique):
         if state.globals["predecessor"]:
             h.update(state.globals["predecessor"].encode("utf-8"))
         h_hexdigest = h.hexdigest()
-        # Store the signature into the state.
-        state.globals["state_signature"] = h_hexdigest
         return str(h_hexdigest)
 
+    def _blocks(self, state:SimState):
+        if self.blocks is None:
+            self.blocks = BlockCache.for_project(state.project)
+        return self.blocks
+
+    def _add_node(self, node_id:str, **attrs):
+        if self.keep_graph:
+            self._simgrG.add_node(node_id, **attrs)
+        if self.sink is not None:
+            self.sink.add_node(node_id, **attrs)
+
+    def _add_edge(self, parent_id:str, node_id:str):
+        if self.keep_graph:
+            self._simgrG.add_edge(parent_id, node_id)
+        if self.sink is not None:
+            self.sink.add_edge(parent_id, node_id)
+
+    def export_compact(self, path):
+        if not self.keep_graph:
+            raise ValueError("The graph was not kept in memory (keep_graph=False), "
+                             "export it with write_compact(load_graph(...), path)")
+        return write_compact(self._simgrG, path)
+
     def _update_timeout_info(self, timeout_states: List[SimState]):
         for state in timeout_states:
             s_sig = state.globals["state_signature"]
-            self._simgrG.nodes[s_sig]["timeout"] = True
+            self._add_node(s_sig, timeout = True)
 
     def _add_state_to_graph(self, parent_state_id:str, sim_state_id:str, state:SimState):
 
-        self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr))
-        self._simgrG.add_edge(parent_state_id, sim_state_id)
+        attrs = dict(state_addr = hex(state.addr), path_exploration_id=state.globals["path_exploration_id"])
+        block = self._blocks(state).get(state.addr)
+
+        if block.func_name is not None:
+            attrs.update(color = "green" if block.hooked else "yellow",
+                         func_name="{}".format(block.func_name),
+                         hooked = block.hooked,
+                         call_followed = True)
+
+        attrs['jumpkind'] = state.history.jumpkind
+
+        # The block is lifted once per address
+        if state.addr != RET_ADDR and block.size:
+            attrs['bb_ins'] = block.mnemonics
+            attrs['bb_size'] = block.size
+            if state.callstack.current_function_address:
+                attrs['callstack_curr_func_addr'] = str(hex(state.callstack.current_function_address))
+
+        self._add_node(sim_state_id, **attrs)
+        self._add_edge(parent_state_id, sim_state_id)
 
-        if state.addr in self.cfg.functions:
-            self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr), color = "green" if state.project.is_hooked(state.addr) else "yellow",
-                                                func_name="{}".format(self.cfg.get_any_node(state.addr).name),
-                                                hooked = True if state.project.is_hooked(state.addr) else False,
-                                                call_followed = True,
-                                                path_exploration_id=state.globals["path_exploration_id"])
-        else:
-            self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr), path_exploration_id=state.globals["path_exploration_id"])
-
-        self._simgrG.nodes[sim_state_id]['jumpkind'] = state.history.jumpkind
-
-        # This can be heavy
-        if state.addr != RET_ADDR:
-            try:
-                self._simgrG.nodes[sim_state_id]['bb_ins'] = [x.mnemonic for x in state.block().disassembly.insns]
-                self._simgrG.nodes[sim_state_id]['bb_size'] = state.block().size
-                if state.callstack.current_function_address:
-                    self._simgrG.nodes[sim_state_id]['callstack_curr_func_addr'] = str(hex(state.callstack.current_function_address))
-            except Exception:
-                pass
-            
     def _tag_fake_ret(self, state:SimState):
         if state.history.jumpkind == "Ijk_FakeRet":
-            self._simgrG.nodes[state.globals["state_signature"]]['call_followed'] = False
-            self._simgrG.nodes[state.globals["state_signature"]]['color'] = "red"
+            self._add_node(state.globals["state_signature"], call_followed = False, color = "red")
 
     def successors(self, simgr, state:SimState, **kwargs):
         succs = simgr.successors(state, **kwargs)
         self._tag_fake_ret(state)
         if self._start:
             assert(not state.globals["predecessor"])
-            sim_state_id = self.get_state_hash(state)
-
-            if state.addr in self.cfg.functions:
-                if state.project.is_hooked(state.addr):
-                    self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr), color = "green",
-                                                        hooked = True,
-                                                        func_name="{}".format(self.cfg.get_any_node(state.addr).name))
+            sim_state_id = self.get_state_id(state)
+
+            block = self._blocks(state).get(state.addr)
+            if block.func_name is not None:
+                if block.hooked:
+                    self._add_node(sim_state_id, state_addr = hex(state.addr), color = "green",
+                                                 hooked = True,
+                                                 func_name="{}".format(block.func_name))
                 else:
-                    self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr), color = "yellow",
-                                                        hooked = False,
-                                                        func_name="{}".format(self.cfg.get_any_node(state.addr).name))
+                    self._add_node(sim_state_id, state_addr = hex(state.addr), color = "yellow",
+                                                 hooked = False,
+                                                 func_name="{}".format(block.func_name))
             else:
-                self._simgrG.add_node(sim_state_id, state_addr = hex(state.addr))
+                self._add_node(sim_state_id, state_addr = hex(state.addr))
 
             self._start = False
 
@@ -142,7 +195,7 @@ class SimgrViz(ExplorationTechnique):
             succ_state.globals["predecessor"] = state.globals["state_signature"]
             parent_state_id = succ_state.globals["predecessor"]
             succ_state.globals["path_exploration_id"] = self._path_exploration_id
-            sim_state_id = self.get_state_hash(succ_state)
+            sim_state_id = self.get_state_id(succ_state)
 
             self._add_state_to_graph(parent_state_id, sim_state_id, succ_state)
 
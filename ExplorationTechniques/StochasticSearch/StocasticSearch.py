@@ -1,11 +1,35 @@
+import atexit
 import logging
+import os
 import random
-from collections import defaultdict
+import struct
+import time
+import weakref
+from array import array
+from collections import OrderedDict, defaultdict, deque
 
 from angr.exploration_techniques import ExplorationTechnique
 
 l = logging.getLogger('syml')
 
+MAGIC = b'AASTAFF1'
+# magic, number of entries, sha256 of the executable ranges (see CoverageMap.binary_tag)
+HEADER = struct.Struct('<8sQ32s')
+# seconds between two saves of the learned affinity on restart
+SAVE_INTERVAL = 30
+
+# searches whose learned table is saved when the process exits, without keeping them alive
+_save_at_exit = weakref.WeakSet()
+
+
+@atexit.register
+def _save_tables():
+    for search in list(_save_at_exit):
+        try:
+            search.save()
+        except OSError as e:
+            l.warning(f'Could not save {search.table_path}: {e}')
+
 
 class StochasticSearch(ExplorationTechnique):
     """
@@ -15,48 +39,226 @@ class StochasticSearch(ExplorationTechnique):
     Before each pass through, weights are randomly assigned to each basic block.
     These weights form a probability distribution for determining which state remains after splits.
     When we run out of active paths to step, we start again from the start state.
+
+    Optionally, copies of the diverging states are cached at the branch points we go through
+    (LRU, bounded by count and estimated memory) and restarts resume from a random cached
+    branch point, or from the start state, instead of re-executing the common prefix.
+
+    With adaptive=True the weights are learned instead of drawn at random, and kept across restarts:
+    every choice among diverging states is rewarded with the new blocks (and the targets) reached
+    until the next choice, plus the discounted reward of the following choices of the same pass.
+    The weight of a block is an exponential moving average of the rewards of choosing it, blocks
+    never chosen start from an optimistic value so that they are tried first. The learned table
+    can be saved to a file and loaded again by the next runs on the same binary: it is saved on
+    restarts (every SAVE_INTERVAL seconds at most) and at exit, call save() when the run ends.
     """
 
-    def __init__(self, restart_prob=0.0001, **kwargs):
+    def __init__(self, restart_prob=0.0001, max_checkpoints=0, max_checkpoint_mem=None, adaptive=False,
+                 targets=(), target_reward=10., learning_rate=0.1, discount=0.9, exploration=0.05,
+                 initial_value=1., max_trail=64, table_path=None, **kwargs):
         """
-        :param start_state:  The initial state from which exploration stems.
-        :param restart_prob: The probability of randomly restarting the search (default 0.0001).
+        :param start_state:        The initial state from which exploration stems.
+        :param restart_prob:       The probability of randomly restarting the search (default 0.0001).
+        :param max_checkpoints:    Branch points to keep for restarts (default 0, always restart from the start state).
+        :param max_checkpoint_mem: Bytes of cached states to keep for restarts (default None, no limit).
+        :param adaptive:           Learn the weights from the coverage instead of drawing them (default False).
+        :param targets:            Addresses whose reaching is rewarded with target_reward (default none).
+        :param target_reward:      Reward for reaching a target, a new block is worth 1 (default 10).
+        :param learning_rate:      Step of the moving average of the rewards (default 0.1).
+        :param discount:           Share of the reward of a choice credited to the choice before it (default 0.9).
+        :param exploration:        Weight added to every block, so that no choice is ruled out (default 0.05).
+        :param initial_value:      Weight of the blocks never chosen (default 1).
+        :param max_trail:          Choices of a pass credited with its rewards (default 64, the latest ones).
+        :param table_path:         File the learned weights are loaded from and saved to (default None).
         """
         super(StochasticSearch, self).__init__()
         self.restart_prob = restart_prob
         self._random = random.Random()
         self._random.seed(42)
         self.affinity = defaultdict(self._random.random)
+        self.max_checkpoints = max_checkpoints
+        self.max_checkpoint_mem = max_checkpoint_mem
+        # branch address -> (states, estimated size), least recently used first
+        self.checkpoints = OrderedDict()
+        self.checkpoint_mem = 0
+        # states handed over by someone else (i.e., ParallelExplorer), explored on the next restarts
+        self.adopted = []
+
+        self.adaptive = adaptive
+        self.targets = set(targets)
+        self.target_reward = target_reward
+        self.learning_rate = learning_rate
+        self.discount = discount
+        self.exploration = exploration
+        self.initial_value = initial_value
+        self.table_path = table_path
+        # block address -> learned weight
+        self.values = dict()
+        self.covered = set()
+        # [address, reward] of the choices of the current pass
+        self._trail = deque(maxlen=max_trail)
+        self._reached = set()
+        self._tag = None
+        self._saved = time.perf_counter()
+        self._cpu_started = time.process_time()
 
     def setup(self, simgr):
         super(StochasticSearch, self).setup(simgr)
         self.start_state = simgr.one_active
+        if self.adaptive and self.table_path is not None:
+            # only the runs saving their table need Utils/CoverageMap
+            from CoverageMap import binary_tag
+            self._tag = binary_tag(simgr._project)
+            self.load()
+            # what was learned since the last save is not lost if the caller does not save()
+            _save_at_exit.add(self)
+        self._cpu_started = time.process_time()
 
     def step(self, simgr, stash='active', **kwargs):
         simgr = simgr.step(stash=stash, **kwargs)
 
+        if len(simgr.stashes[stash]) > 1 and self.max_checkpoints:
+            self.checkpoint(simgr.stashes[stash])
+
         if not simgr.stashes[stash] or self._random.random() < self.restart_prob:
-            simgr.stashes[stash] = [self.start_state]
+            if self.adaptive:
+                self.end_pass()
+            simgr.stashes[stash] = self.restart_states()
             self.affinity.clear()
 
-        if len(simgr.stashes[stash]) > 1:
-            def weighted_pick(states):
-                """
-                param states: Diverging states.
-                """
-                assert len(states) >= 2
-                total_weight = sum((self.affinity[s.addr] for s in states))
-                selected = self._random.uniform(0, total_weight)
-                i = 0
-                for i, state in enumerate(states):
-                    weight = self.affinity[state.addr]
-                    if selected < weight:
-                        break
-                    else:
-                        selected -= weight
-                picked = states[i]
-                return picked
-
-            simgr.stashes[stash] = [weighted_pick(simgr.stashes[stash])]
-
-        return simgr
\ No newline at end of file
+        chose = len(simgr.stashes[stash]) > 1
+        if chose:
+            # a fork has two or three successors, a linear weighted choice is the cheapest
+            weight = self.weight if self.adaptive else lambda s: self.affinity[s.addr]
+            states = simgr.stashes[stash]
+            simgr.stashes[stash] = self._random.choices(states, weights=[weight(s) for s in states])
+
+        if self.adaptive and simgr.stashes[stash]:
+            self.reward(simgr.stashes[stash][0], chose)
+
+        return simgr
+
+    def weight(self, state):
+        return self.values.get(state.addr, self.initial_value) + self.exploration
+
+    def reward(self, state, chose):
+        """
+        Credit the block reached by the kept state to the last choice of the pass.
+        """
+        r = 0.
+        if state.addr not in self.covered:
+            self.covered.add(state.addr)
+            r += 1.
+        # once per pass, looping over a target is not worth more
+        if state.addr in self.targets and state.addr not in self._reached:
+            self._reached.add(state.addr)
+            r += self.target_reward
+        if chose:
+            self._trail.append([state.addr, r])
+        elif self._trail:
+            self._trail[-1][1] += r
+
+    def end_pass(self):
+        # returns of the choices, from the last one back
+        ret = 0.
+        while self._trail:
+            addr, r = self._trail.pop()
+            ret = r + self.discount * ret
+            value = self.values.get(addr, self.initial_value)
+            self.values[addr] = value + self.learning_rate * (ret - value)
+        self._reached.clear()
+        l.debug(f'{len(self.covered)} blocks covered, {self.coverage_rate:.1f} blocks per CPU-second')
+        if self.table_path is not None and time.perf_counter() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    @property
+    def coverage_rate(self):
+        cpu = time.process_time() - self._cpu_started
+        return len(self.covered) / cpu if cpu > 0 else 0.
+
+    def save(self, path=None):
+        """
+        Write the learned weights (two packed arrays) to path (default: table_path), atomically.
+        """
+        path = path if path is not None else self.table_path
+        addrs = array('Q', self.values.keys())
+        values = array('d', self.values.values())
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, len(addrs), self._tag or bytes(32)))
+            addrs.tofile(fp)
+            values.tofile(fp)
+        os.replace(tmp_path, path)
+        self._saved = time.perf_counter()
+
+    def close(self):
+        """
+        Save the learned table, i.e. in a worker process that may not run the exit handlers.
+        """
+        if self in _save_at_exit:
+            _save_at_exit.discard(self)
+            self.save()
+
+    def load(self, path=None):
+        path = path if path is not None else self.table_path
+        try:
+            with open(path, 'rb') as fp:
+                magic, n, tag = HEADER.unpack(fp.read(HEADER.size))
+                if magic != MAGIC or (self._tag is not None and tag != self._tag):
+                    l.warning(f'{path} was written for another binary, not loading it')
+                    return
+                addrs, values = array('Q'), array('d')
+                addrs.fromfile(fp, n)
+                values.fromfile(fp, n)
+        except FileNotFoundError:
+            return
+        except (EOFError, struct.error):
+            l.warning(f'{path} is truncated, not loading it')
+            return
+        self.values.update(zip(addrs, values))
+        l.info(f'Loaded the weights of {n} blocks from {path}')
+
+    def checkpoint(self, states):
+        """
+        param states: Diverging states.
+        """
+        branch = states[0].history.addr
+        if branch in self.checkpoints:
+            self.checkpoints.move_to_end(branch)
+            return
+
+        size = sum(self.state_size(s) for s in states)
+        self.checkpoints[branch] = ([s.copy() for s in states], size)
+        self.checkpoint_mem += size
+
+        while len(self.checkpoints) > self.max_checkpoints or \
+                (self.max_checkpoint_mem is not None and self.checkpoint_mem > self.max_checkpoint_mem):
+            _, (_, evicted_size) = self.checkpoints.popitem(last=False)
+            self.checkpoint_mem -= evicted_size
+            if not self.checkpoints:
+                break
+
+    def adopt(self, states):
+        self.adopted.extend(states)
+
+    def restart_states(self):
+        if self.adopted:
+            return [self.adopted.pop()]
+
+        # the start state is one more candidate among the cached branch points
+        n = self._random.randrange(len(self.checkpoints) + 1)
+        if n == len(self.checkpoints):
+            return [self.start_state]
+
+        branch = next(k for i, k in enumerate(self.checkpoints) if i == n)
+        self.checkpoints.move_to_end(branch)
+        l.debug(f'restarting from branch point {hex(branch)}')
+        return [s.copy() for s in self.checkpoints[branch][0]]
+
+    @staticmethod
+    def state_size(state):
+        # pessimistic: pages shared copy-on-write with other states are counted for every state
+        try:
+            return len(state.memory._pages) * state.memory.page_size
+        except AttributeError:
+            return 0
@@ -0,0 +1,98 @@
+import logging
+import weakref
+from collections import OrderedDict
+
+l = logging.getLogger('BlockCache')
+
+
+class BlockInfo(object):
+    """
+    What the exploration techniques need to know about a basic block.
+    A block that could not be lifted has size 0 and no instructions.
+    """
+    __slots__ = ('addr', 'size', 'instructions', 'func_name', 'hooked', '_mnemonics', '_project')
+
+    def __init__(self, project, addr):
+        self.addr = addr
+        self.hooked = project.is_hooked(addr)
+        func = project.kb.functions.get(addr, None)
+        self.func_name = func.name if func is not None else None
+        # a strong reference would keep the project (the key of BlockCache._caches) alive
+        self._project = weakref.proxy(project)
+        self._mnemonics = None
+        try:
+            block = project.factory.block(addr)
+            self.size = block.size
+            self.instructions = block.instructions
+        except Exception:
+            self.size = 0
+            self.instructions = 0
+
+    @property
+    def mnemonics(self):
+        # disassembling is way heavier than lifting, only do it for who asks
+        if self._mnemonics is None:
+            try:
+                insns = self._project.factory.block(self.addr).disassembly.insns
+                self._mnemonics = [x.mnemonic for x in insns]
+            except Exception:
+                self._mnemonics = []
+        return self._mnemonics
+
+
+class BlockCache(object):
+    """
+    Address-keyed cache of BlockInfo shared by all the techniques working on a project.
+
+    Blocks are lifted from the loaded binary (i.e., project.factory.block), not from the
+    memory of a state, and function names come from project.kb.functions at the time of
+    the first lookup, so build the CFG before stepping. Least recently used blocks are
+    evicted once max_size blocks are cached.
+    """
+    _caches = weakref.WeakKeyDictionary()
+
+    def __init__(self, project, max_size=0x10000):
+        # weak, so that the cache goes away with the project
+        self._project = weakref.ref(project)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    @property
+    def project(self):
+        return self._project()
+
+    @classmethod
+    def for_project(cls, project, max_size=0x10000):
+        """
+        The BlockCache shared by everyone working on project.
+        """
+        cache = cls._caches.get(project)
+        if cache is None:
+            cache = cls(project, max_size=max_size)
+            cls._caches[project] = cache
+        return cache
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, addr):
+        return addr in self._blocks
+
+    def get(self, addr):
+        try:
+            info = self._blocks[addr]
+        except KeyError:
+            self.misses += 1
+            info = BlockInfo(self.project, addr)
+            self._blocks[addr] = info
+            if len(self._blocks) > self.max_size:
+                self._blocks.popitem(last=False)
+            return info
+        self.hits += 1
+        self._blocks.move_to_end(addr)
+        return info
+
+    def clear(self):
+        self._blocks.clear()
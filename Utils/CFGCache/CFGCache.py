@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+import angr
+
+l = logging.getLogger('CFGCache')
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'awesome-angr', 'cfg')
+# entries written by another layout of the cache are not looked up
+FORMAT = b'model+functions'
+
+
+class _CFGPickler(pickle.Pickler):
+    # the project (loader with all the object bytes, hooks, ...) and its KB are not written
+    def __init__(self, fp, project):
+        super(_CFGPickler, self).__init__(fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = {id(project): 'project', id(project.kb): 'kb', id(project.loader): 'loader'}
+
+    def persistent_id(self, obj):
+        return self.shared.get(id(obj))
+
+
+class _CFGUnpickler(pickle.Unpickler):
+    def __init__(self, fp, project):
+        super(_CFGUnpickler, self).__init__(fp)
+        self.shared = {'project': project, 'kb': project.kb, 'loader': project.loader}
+
+    def persistent_load(self, pid):
+        try:
+            return self.shared[pid]
+        except KeyError:
+            raise pickle.UnpicklingError(f'unknown persistent id {pid!r}')
+
+
+class CachedCFG(object):
+    """
+    What a cache entry holds of a CFGFast: its model and the function manager, bound to the live project.
+    Attributes of the model (graph, get_any_node, ...) are reachable from here too.
+    """
+
+    def __init__(self, project, model, functions):
+        self.project = project
+        self.kb = project.kb
+        self.model = model
+        self.functions = functions
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['model'], name)
+
+
+class CFGCache(object):
+    """
+    On-disk cache of CFGFast results.
+
+    Entries are keyed by a hash of the bytes of every loaded object, the angr version and the
+    CFGFast options. A SimState passed as an option (i.e., base_state) only contributes
+    its address to the key. Only the CFG model and the function manager are cached, pickled
+    without the project and its KB: when a CFG is loaded from the cache they are rebound to the
+    live project and its functions are registered in project.kb, as if CFGFast had run on it.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, project, **kwargs):
+        h = hashlib.sha256()
+        h.update(angr.__version__.encode("utf-8"))
+        h.update(FORMAT)
+        for obj in project.loader.all_objects:
+            if obj.binary and os.path.isfile(obj.binary):
+                with open(obj.binary, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 20), b''):
+                        h.update(chunk)
+            h.update(hex(obj.mapped_base).encode("utf-8"))
+        for name, value in sorted(kwargs.items()):
+            if isinstance(value, angr.SimState):
+                value = ('SimState', hex(value.addr))
+            h.update(f'{name}={value!r};'.encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def CFGFast(self, project, **kwargs):
+        """
+        Drop-in replacement of project.analyses.CFGFast(**kwargs).
+        """
+        key = self.key(project, **kwargs)
+        cfg = self.load(project, key)
+        if cfg is not None:
+            self.hits += 1
+            return cfg
+
+        self.misses += 1
+        cfg = project.analyses.CFGFast(**kwargs)
+        self.store(key, cfg, project)
+        return cfg
+
+    def load(self, project, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as fp:
+                model, functions = _CFGUnpickler(fp, project).load()
+        except Exception as e:
+            l.warning(f'Ignoring broken CFG cache entry {path}: {e}')
+            return None
+        project.kb.register_plugin('functions', functions)
+        l.debug(f'CFG loaded from {path}')
+        return CachedCFG(project, model, functions)
+
+    def store(self, key, cfg, project):
+        # write to a temporary file first, concurrent runs may be storing the same entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                _CFGPickler(fp, project).dump((cfg.model, cfg.kb.functions))
+            os.replace(tmp_path, self.path(key))
+        except Exception as e:
+            l.warning(f'Could not store the CFG in the cache: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
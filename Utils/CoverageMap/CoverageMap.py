@@ -0,0 +1,186 @@
+import bisect
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+l = logging.getLogger('CoverageMap')
+
+MAGIC = b'AACOVMAP'
+# magic, number of bits, sha256 of the executable ranges
+HEADER = struct.Struct('<8sQ32s')
+
+
+def executable_ranges(project):
+    """
+    Sorted (start, size) of the executable segments (sections when there are none) of the loaded objects.
+    """
+    ranges = []
+    for obj in project.loader.all_objects:
+        regions = [r for r in getattr(obj, 'segments', ()) if r.is_executable]
+        if not regions:
+            regions = [r for r in getattr(obj, 'sections', ()) if r.is_executable]
+        for r in regions:
+            if r.memsize:
+                ranges.append((r.vaddr, r.memsize))
+    ranges.sort()
+    # overlapping regions (i.e., a section inside a segment) are merged
+    merged = []
+    for start, size in ranges:
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            prev_start, prev_size = merged[-1]
+            merged[-1] = (prev_start, max(prev_size, start + size - prev_start))
+        else:
+            merged.append((start, size))
+    return merged
+
+
+def binary_tag(project, ranges=None):
+    """
+    sha256 of the executable ranges of a project and of their bytes, to tell apart files written for another binary.
+    """
+    h = hashlib.sha256()
+    for start, size in (ranges if ranges is not None else executable_ranges(project)):
+        h.update(struct.pack('<QQ', start, size))
+        h.update(project.loader.memory.load(start, size))
+    return h.digest()
+
+
+class CoverageMap(object):
+    """
+    Set of covered addresses stored as a bitmap, one bit per byte of the executable ranges of a project.
+
+    The bitmap is a bytearray, or a memory-mapped file when a path is given: concurrent explorations
+    of the same binary mapping the same file share their coverage, and the file keeps it across runs.
+    The file is tagged with a hash of the executable ranges and their bytes, and it is reset when it
+    does not match the binary. The header is checked (and the file reset or resized) under an flock,
+    bits are set without locking: a bit lost to a concurrent write only means that another run
+    re-covers that block.
+    Addresses outside the executable ranges (i.e., SimProcedures) are kept in a plain set.
+    """
+
+    def __init__(self, project, path=None):
+        """
+        :param project: The angr Project whose executable ranges are mapped.
+        :param path:    File backing the bitmap (default None, in memory only).
+        """
+        self.path = path
+        self.ranges = executable_ranges(project)
+        self._starts = [start for start, _ in self.ranges]
+        self._offsets = []
+        nbits = 0
+        for _, size in self.ranges:
+            self._offsets.append(nbits)
+            nbits += size
+        self.nbits = nbits
+        self.others = set()
+        self._fp = None
+
+        nbytes = (nbits + 7) // 8
+        if path is None:
+            self._mm = None
+            self.bits = bytearray(nbytes)
+        else:
+            self._mm = self._map(path, binary_tag(project, self.ranges), nbytes)
+            self.bits = memoryview(self._mm)[HEADER.size:]
+        self._synced = bytearray(self.bits)
+
+    def _map(self, path, tag, nbytes):
+        header = HEADER.pack(MAGIC, self.nbits, tag)
+        size = HEADER.size + nbytes
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fp = os.fdopen(fd, 'r+b')
+        # concurrent runs check, reset and resize the file one at a time, and the file is never
+        # truncated under someone who has it mapped
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            current = self._fp.read(HEADER.size)
+            if current != header:
+                if current:
+                    l.warning(f'{path} was written for another binary, resetting it')
+                self._fp.seek(0)
+                self._fp.write(header + bytes(nbytes))
+                self._fp.flush()
+            if os.fstat(fd).st_size < size:
+                self._fp.truncate(size)
+            return mmap.mmap(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _index(self, addr):
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0:
+            return None
+        start, size = self.ranges[i]
+        if addr >= start + size:
+            return None
+        return self._offsets[i] + addr - start
+
+    def _addr(self, index):
+        i = bisect.bisect_right(self._offsets, index) - 1
+        return self.ranges[i][0] + index - self._offsets[i]
+
+    def __contains__(self, addr):
+        index = self._index(addr)
+        if index is None:
+            return addr in self.others
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, addr):
+        index = self._index(addr)
+        if index is None:
+            self.others.add(addr)
+        else:
+            self.bits[index >> 3] |= 1 << (index & 7)
+            self._synced[index >> 3] |= 1 << (index & 7)
+
+    def discard(self, addr):
+        index = self._index(addr)
+        if index is None:
+            self.others.discard(addr)
+        else:
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    def __iter__(self):
+        yield from self._addrs(bytes(self.bits))
+        yield from list(self.others)
+
+    def __len__(self):
+        return bin(int.from_bytes(bytes(self.bits), 'little')).count('1') + len(self.others)
+
+    def _addrs(self, data, base=0):
+        for i, byte in enumerate(data):
+            while byte:
+                bit = (byte & -byte).bit_length() - 1
+                yield self._addr(((base + i) << 3) + bit)
+                byte &= byte - 1
+
+    def sync(self, chunk=4096):
+        """
+        Addresses added by someone else (i.e., another process mapping the file) since the last sync.
+        Chunks are compared in place, only the ones that changed are copied and scanned.
+        """
+        synced = memoryview(self._synced)
+        new = []
+        for base in range(0, len(self._synced), chunk):
+            cur, old = self.bits[base:base + chunk], synced[base:base + chunk]
+            if cur != old:
+                cur = bytes(cur)
+                diff = bytes(c & ~o & 0xff for c, o in zip(cur, old))
+                new.extend(self._addrs(diff, base))
+                synced[base:base + chunk] = cur
+        synced.release()
+        return new
+
+    def flush(self):
+        if self._mm is not None:
+            self._mm.flush()
+
+    def close(self):
+        if self._mm is not None:
+            self.bits.release()
+            self._mm.close()
+            self._fp.close()
+            self._mm = None
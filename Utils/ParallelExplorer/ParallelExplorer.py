@@ -0,0 +1,239 @@
+import logging
+import multiprocessing
+import os
+import random
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+from MemLimiter import evict
+from SpillStash import SpilledState, dumps, loads
+
+l = logging.getLogger('ParallelExplorer')
+
+
+def share_coverage(technique, addrs):
+    """
+    Let a technique know about the blocks covered by the other workers.
+    """
+    covered = getattr(technique, 'covered', None)
+    if covered is None:
+        return
+    md2u = getattr(technique, 'md2u', None)
+    for addr in addrs:
+        if addr not in covered:
+            covered.add(addr)
+            if md2u is not None:
+                md2u.cover(addr)
+
+
+def _worker(conn, index, project_factory, technique_factory, seed, steps_per_round, result_stashes):
+    random.seed(seed + index)
+    project = project_factory()
+    simgr = None
+    techniques = []
+    covered = set()
+
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'stop':
+            # i.e. StochasticSearch saves its learned table, a worker that does not stop in time is terminated
+            for t in techniques:
+                if hasattr(t, 'close'):
+                    t.close()
+            break
+        _, incoming, coverage, donate = msg
+
+        states = [loads(blob, project) for blob in incoming]
+        if simgr is None and states:
+            simgr = project.factory.simulation_manager(states)
+            techniques = technique_factory()
+            for t in techniques:
+                simgr.use_technique(t)
+                # coverage of the previous explore() calls, received before there was a technique
+                share_coverage(t, covered)
+        elif states:
+            adopters = [t for t in techniques if hasattr(t, 'adopt')]
+            if adopters:
+                # i.e. StochasticSearch, which would keep a single active state and drop the others
+                adopters[0].adopt(states)
+            else:
+                simgr.stashes['active'].extend(states)
+        covered.update(coverage)
+        for t in techniques:
+            share_coverage(t, coverage)
+
+        new_coverage = set()
+        results = dict()
+        donated = []
+        if simgr is not None:
+            for _ in range(steps_per_round):
+                if not simgr.active:
+                    break
+                simgr.step()
+                for s in simgr.active:
+                    if s.addr not in covered:
+                        covered.add(s.addr)
+                        new_coverage.add(s.addr)
+
+            for name in result_stashes:
+                if simgr.stashes[name]:
+                    results[name] = [dumps(s, project) for s in simgr.stashes[name]]
+                    simgr.stashes[name] = []
+
+            # work stealing: hand half of the in-memory deferred states to idle workers
+            deferred = simgr.stashes['deferred']
+            if donate and len(deferred) > 1:
+                give = [s for s in deferred if not isinstance(s, SpilledState)][:min(donate, len(deferred) // 2)]
+                if give:
+                    given = {id(s) for s in give}
+                    simgr.stashes['deferred'] = [s for s in deferred if id(s) not in given]
+                    # the searches of this worker must not pick them anymore
+                    evict(simgr, give)
+                    donated = [dumps(s, project) for s in give]
+
+        frontier = len(simgr.active) + len(simgr.stashes['deferred']) if simgr is not None else 0
+        conn.send(('report', new_coverage, results, donated, frontier))
+
+    conn.close()
+
+
+class ParallelExplorer(object):
+    """
+    Process-pool driver running a search technique in every worker over a shared frontier.
+
+    The coordinator steps the initial states breadth-first until there is a state per worker,
+    then hands them out. Every worker runs its own SimulationManager with a copy of the technique
+    (StochasticSearch, KLEERandomSearch, KLEECoverageOptimizeSearch, AEGLoopExhaustion...) for
+    steps_per_round steps and reports back: the newly covered blocks, its result stashes, and
+    deferred states donated to idle workers when asked to. States travel pickled without the
+    project (see SpillStash.dumps), every worker builds its own with project_factory.
+    Global coverage is sent back with every round, techniques keeping a `covered` set
+    (and `md2u`, i.e. KLEECoverageOptimizeSearch) are updated with it.
+    Donated states join the 'active' stash of the receiving worker, unless one of its techniques
+    has an `adopt(states)` method, i.e. StochasticSearch, which explores them on its next restarts.
+    The exploration ends when every worker is idle and no state is waiting, or on max_time.
+    StochasticSearch always restarts from its start state, so its workers never go idle:
+    give it a max_time.
+    """
+
+    def __init__(self, project_factory, technique_factory, n_workers=None, steps_per_round=100,
+                 max_time=None, seed=0, result_stashes=('found', 'deadended')):
+        """
+        :param project_factory:   Picklable callable returning the angr Project (i.e. functools.partial(angr.Project, path)).
+        :param technique_factory: Picklable callable returning the list of techniques of a worker.
+        :param n_workers:         Worker processes (default: the number of cores).
+        :param steps_per_round:   Steps run by a worker between two reports.
+        :param max_time:          Wall-clock seconds before stopping the workers (default None, no limit).
+        :param seed:              Worker i seeds the random module with seed + i.
+        :param result_stashes:    Stashes merged back to the coordinator.
+        """
+        self.project_factory = project_factory
+        self.technique_factory = technique_factory
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.steps_per_round = steps_per_round
+        self.max_time = max_time
+        self.seed = seed
+        self.result_stashes = result_stashes
+        self.project = None
+        self.results = {name: [] for name in result_stashes}
+        self.coverage = []
+        self.rounds = 0
+
+    def explore(self, states, project=None, max_warmup_steps=100):
+        """
+        :param states:  The initial states.
+        :param project: The project of the states (default: a new one from project_factory).
+        :return:        The result stashes, states attached to project.
+        """
+        self.project = project if project is not None else self.project_factory()
+        pending = deque(dumps(s, self.project) for s in self._warmup(states, max_warmup_steps))
+        covered = set(self.coverage)
+
+        ctx = multiprocessing.get_context('spawn')
+        conns = []
+        procs = []
+        for i in range(self.n_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker, name=f'ParallelExplorer-{i}', daemon=True,
+                               args=(child_conn, i, self.project_factory, self.technique_factory, self.seed,
+                                     self.steps_per_round, self.result_stashes))
+            proc.start()
+            child_conn.close()
+            conns.append(parent_conn)
+            procs.append(proc)
+
+        # index in self.coverage up to which every worker was told
+        synced = {conn: 0 for conn in conns}
+        idle = set()
+        started = time.perf_counter()
+        for conn in conns:
+            self._send(conn, pending, synced)
+        try:
+            while len(idle) < len(conns) or pending:
+                if self.max_time is not None and time.perf_counter() - started > self.max_time:
+                    l.info('Time budget used up')
+                    break
+                for conn in wait([c for c in conns if c not in idle], timeout=1):
+                    _, new_coverage, results, donated, frontier = conn.recv()
+                    self.rounds += 1
+                    for addr in new_coverage - covered:
+                        covered.add(addr)
+                        self.coverage.append(addr)
+                    for name, blobs in results.items():
+                        self.results[name].extend(loads(blob, self.project) for blob in blobs)
+                    pending.extend(donated)
+
+                    if frontier == 0 and not pending:
+                        idle.add(conn)
+                    else:
+                        self._send(conn, pending, synced, n_hungry=len(idle))
+                # wake up the idle workers if someone donated
+                for conn in list(idle):
+                    if not pending:
+                        break
+                    idle.discard(conn)
+                    self._send(conn, pending, synced)
+        finally:
+            for conn in conns:
+                try:
+                    conn.send(('stop',))
+                except (BrokenPipeError, OSError):
+                    pass
+            self._drain(conns)
+            for proc in procs:
+                proc.join(timeout=5)
+                if proc.is_alive():
+                    proc.terminate()
+
+        l.info(f'{self.rounds} rounds, {len(self.coverage)} blocks covered, ' +
+               ', '.join(f'{len(states)} {name}' for name, states in self.results.items()))
+        return self.results
+
+    def _warmup(self, states, max_steps):
+        # step breadth-first until there is a state for every worker
+        simgr = self.project.factory.simulation_manager(list(states))
+        for _ in range(max_steps):
+            if len(simgr.active) >= self.n_workers or not simgr.active:
+                break
+            simgr.step()
+        for name in self.result_stashes:
+            self.results[name].extend(simgr.stashes[name])
+        return simgr.active
+
+    def _send(self, conn, pending, synced, n_hungry=0):
+        give = [pending.popleft()] if pending else []
+        coverage = self.coverage[synced[conn]:]
+        synced[conn] = len(self.coverage)
+        conn.send(('round', give, coverage, n_hungry))
+
+    def _drain(self, conns):
+        # reports sent while stopping still carry results
+        for conn in conns:
+            try:
+                while conn.poll(1):
+                    msg = conn.recv()
+                    for name, blobs in msg[2].items():
+                        self.results[name].extend(loads(blob, self.project) for blob in blobs)
+            except (EOFError, OSError):
+                pass
@@ -0,0 +1,186 @@
+import io
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+
+l = logging.getLogger('SpillStash')
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SpilledLoopData(object):
+    __slots__ = ('back_edge_trip_counts', 'current_loop')
+
+    def __init__(self, loop_data):
+        self.back_edge_trip_counts = {addr: list(counts) for addr, counts in loop_data.back_edge_trip_counts.items()}
+        self.current_loop = list(loop_data.current_loop)
+
+
+class SpilledState(object):
+    """
+    Stub left in a stash in place of a state that was paged out to disk.
+
+    It keeps what the schedulers rank on: the address, a copy of the globals and,
+    when the state has a loop_data plugin, the loop trip counts.
+    The file holding the state is removed when the stub is garbage collected.
+    """
+    __slots__ = ('addr', 'globals', 'loop_data', 'path', '_finalizer', '__weakref__')
+
+    def __init__(self, state, path):
+        self.addr = state.addr
+        self.globals = dict(state.globals.items())
+        self.loop_data = SpilledLoopData(state.loop_data) if state.has_plugin('loop_data') else None
+        self.path = path
+        self._finalizer = weakref.finalize(self, _unlink, path)
+
+    def __repr__(self):
+        return f'<SpilledState @ {self.addr:#x}>'
+
+
+class _StatePickler(pickle.Pickler):
+    # the project is shared by all the states, it is not written with every one of them
+    def __init__(self, fp, project):
+        super(_StatePickler, self).__init__(fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.project = project
+
+    def persistent_id(self, obj):
+        if obj is self.project:
+            return 'project'
+        return None
+
+
+class _StateUnpickler(pickle.Unpickler):
+    def __init__(self, fp, project):
+        super(_StateUnpickler, self).__init__(fp)
+        self.project = project
+
+    def persistent_load(self, pid):
+        if pid == 'project':
+            return self.project
+        raise pickle.UnpicklingError(f'unknown persistent id {pid!r}')
+
+
+def dumps(obj, project):
+    """
+    Pickle states (or anything holding states) without the project they belong to.
+    """
+    fp = io.BytesIO()
+    _StatePickler(fp, project).dump(obj)
+    return fp.getvalue()
+
+
+def loads(data, project):
+    """
+    Unpickle what dumps() wrote, attaching the states to project.
+    """
+    return _StateUnpickler(io.BytesIO(data), project).load()
+
+
+class SpillStash(object):
+    """
+    Pages the states of a stash (i.e., 'deferred') out to a spill directory.
+
+    Only the `max_hot` most recently deferred states of the stash are kept in memory, the
+    others are pickled and replaced by a SpilledState stub in the stash list. Selecting a stub
+    pages the state back in. The project is not pickled together with the states.
+
+    The technique tells which states it defers, oldest first, so that shrink does not rescan
+    the stash: the deferred states are held by weak references, the ones that are gone or not
+    in the stash anymore are skipped when their turn to be paged out comes.
+    """
+
+    def __init__(self, max_hot=64, spill_dir=None):
+        """
+        :param max_hot:   States of the stash kept in memory.
+        :param spill_dir: Directory the states are written to (default: a new temporary directory,
+                          removed by close()).
+        """
+        self.max_hot = max_hot
+        self._own_dir = spill_dir is None
+        self.spill_dir = tempfile.mkdtemp(prefix='spill-') if spill_dir is None else spill_dir
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.project = None
+        self.spilled = 0
+        self.loaded = 0
+        # in-memory deferred states, oldest first: id -> weak reference
+        self.hot = OrderedDict()
+
+    def defer(self, states):
+        """
+        Record states appended to the stash, stubs are already paged out.
+        """
+        for s in states:
+            if not isinstance(s, SpilledState):
+                self.hot[id(s)] = weakref.ref(s)
+                self.hot.move_to_end(id(s))
+
+    def shrink(self, states, index):
+        """
+        Page out the oldest in-memory states of a stash list, in place.
+
+        :param states: The stash list.
+        :param index:  The StashIndex of the stash list, the caller lets the stubs take the
+                       places of the states in it.
+        :return:       The (state, stub) pairs that were paged out.
+        """
+        swapped = []
+        while len(self.hot) > self.max_hot:
+            state = self.hot.popitem(last=False)[1]()
+            if state is None:
+                continue
+            pos = index.position(states, state)
+            if pos is None:
+                continue
+            stub = self.page_out(state)
+            if stub is not None:
+                swapped.append((state, stub))
+                states[pos] = stub
+        if swapped:
+            l.debug(f'paged out {len(swapped)} states, {len(self.hot)} left in memory')
+        return swapped
+
+    def page_out(self, state):
+        if self.project is None:
+            self.project = state.project
+        fd, path = tempfile.mkstemp(suffix='.state', dir=self.spill_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                _StatePickler(fp, self.project).dump(state)
+        except Exception as e:
+            l.warning(f'Could not page out {state}: {e}')
+            _unlink(path)
+            return None
+        self.spilled += 1
+        return SpilledState(state, path)
+
+    def load(self, state):
+        """
+        Page a stub back in, states that are in memory are returned as they are.
+        """
+        if not isinstance(state, SpilledState):
+            self.hot.pop(id(state), None)
+            return state
+        with open(state.path, 'rb') as fp:
+            loaded = _StateUnpickler(fp, self.project).load()
+        state._finalizer()
+        self.loaded += 1
+        return loaded
+
+    def page_in(self, states):
+        """
+        Page in every stub of a stash list, i.e. after other techniques moved stubs to 'active'.
+        """
+        return [self.load(s) for s in states]
+
+    def close(self):
+        if self._own_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
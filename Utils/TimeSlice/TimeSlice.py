@@ -0,0 +1,80 @@
+import logging
+import time
+
+l = logging.getLogger('TimeSlice')
+
+
+class TimeSlice(object):
+    """
+    Instruction/time quantum for the KLEE searchers. https://hci.stanford.edu/cstr/reports/2008-03.pdf
+
+    Once selected each process is run for a "time slice" defined by both a maximum number
+    of instructions and a maximum amount of time. The slice is charged after every step of the
+    running state and the searcher only re-selects a state when the slice is used up.
+    States that fork too often, or whose steps are slow because of the constraint solver,
+    are preempted early so that they cannot dominate execution time.
+
+    Every limit is optional (None disables it). With the defaults a state keeps running on
+    straight-line code and is preempted at every fork, as the searchers do without a slice.
+    """
+
+    def __init__(self, max_insns=None, max_time=None, max_forks=1, max_step_time=None):
+        """
+        :param max_insns:     Instructions a state can execute before being preempted.
+        :param max_time:      Wall-clock seconds a state can run before being preempted.
+        :param max_forks:     Forks a state can go through before being preempted.
+        :param max_step_time: Preempt right away after a single step slower than this (seconds),
+                              which is how solver-heavy states show up.
+        """
+        self.max_insns = max_insns
+        self.max_time = max_time
+        self.max_forks = max_forks
+        self.max_step_time = max_step_time
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new slice, called by the searchers when they select a state.
+        """
+        self.insns = 0
+        self.forks = 0
+        self.slow_steps = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def charge(self, state, n_succs, step_time):
+        """
+        Account one step of the running state.
+
+        :param state:     One of the successors produced by the step.
+        :param n_succs:   Number of successors produced by the step.
+        :param step_time: Wall-clock seconds the step took.
+        :return:          True when the slice is used up and a new state must be selected.
+        """
+        # SimProcedures do not report an instruction count
+        self.insns += max(1, state.history.recent_instruction_count)
+        if n_succs > 1:
+            self.forks += 1
+        if self.max_step_time is not None and step_time >= self.max_step_time:
+            self.slow_steps += 1
+
+        return self.expired
+
+    @property
+    def expired(self):
+        if self.max_insns is not None and self.insns >= self.max_insns:
+            l.debug(f'preempted after {self.insns} instructions')
+            return True
+        if self.max_forks is not None and self.forks >= self.max_forks:
+            l.debug(f'preempted after {self.forks} forks')
+            return True
+        if self.slow_steps:
+            l.debug('preempted after a slow step')
+            return True
+        if self.max_time is not None and self.elapsed >= self.max_time:
+            l.debug(f'preempted after {self.elapsed:.2f}s')
+            return True
+        return False
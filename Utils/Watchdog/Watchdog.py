@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+
+l = logging.getLogger('Watchdog')
+
+
+class SolverClock(object):
+    """
+    Cumulative wall-clock time spent in the z3 backend of claripy.
+
+    The public query methods of the backend are wrapped once per process, nested
+    queries (i.e., eval checking satisfiability) are only accounted once.
+    """
+    METHODS = ('satisfiable', 'eval', 'batch_eval', 'min', 'max', 'solution')
+
+    def __init__(self):
+        self.total = 0.
+        self._depth = threading.local()
+        self._installed = False
+        self._lock = threading.Lock()
+
+    def install(self):
+        with self._lock:
+            if self._installed:
+                return
+            import claripy
+            backend = claripy.backends.z3
+            for name in self.METHODS:
+                if hasattr(backend, name):
+                    setattr(backend, name, self._wrap(getattr(backend, name)))
+            self._installed = True
+
+    def _wrap(self, method):
+        def timed(*args, **kwargs):
+            depth = getattr(self._depth, 'value', 0)
+            if depth:
+                return method(*args, **kwargs)
+            self._depth.value = 1
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+                self._depth.value = 0
+        return timed
+
+
+solver_clock = SolverClock()
+
+
+class Watchdog(object):
+    """
+    Wall-clock, step and cumulative solver time budgets for one exploration.
+
+    The time budgets are checked by a timer thread every `interval` seconds, the step budget
+    when a step is charged. When a budget is used up the watchdog records which one fired
+    and sets `expired`, the exploration is then stopped at the next step boundary.
+    """
+
+    def __init__(self, max_time=None, max_steps=None, max_solver_time=None, interval=1., expired=None):
+        """
+        :param max_time:        Wall-clock seconds (default None, no limit).
+        :param max_steps:       Steps of the SimulationManager (default None, no limit).
+        :param max_solver_time: Seconds spent in the constraint solver (default None, no limit).
+        :param interval:        Seconds between two checks of the time budgets.
+        :param expired:         The threading.Event to set when a budget is used up (default: a new one).
+        """
+        self.max_time = max_time
+        self.max_steps = max_steps
+        self.max_solver_time = max_solver_time
+        self.interval = interval
+        self.expired = expired if expired is not None else threading.Event()
+        self.fired = None
+        self.steps = 0
+        self.started = None
+        self._solver_start = 0.
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.max_solver_time is not None:
+            solver_clock.install()
+        self._solver_start = solver_clock.total
+        self.started = time.perf_counter()
+        if self.max_time is not None or self.max_solver_time is not None:
+            self._thread = threading.Thread(target=self._watch, name='Watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started if self.started is not None else 0.
+
+    @property
+    def solver_time(self):
+        return solver_clock.total - self._solver_start
+
+    def charge_step(self):
+        self.steps += 1
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            self.fire('steps')
+        return self.expired.is_set()
+
+    def check(self):
+        if self.max_time is not None and self.elapsed >= self.max_time:
+            self.fire('time')
+        elif self.max_solver_time is not None and self.solver_time >= self.max_solver_time:
+            self.fire('solver_time')
+        return self.expired.is_set()
+
+    def fire(self, budget):
+        if self.expired.is_set():
+            return
+        self.fired = budget
+        l.warning(f'{budget} budget used up after {self.elapsed:.2f}s, {self.steps} steps, '
+                  f'{self.solver_time:.2f}s in the solver')
+        self.expired.set()
+        self.stop()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            if self.check():
+                return
+
+    def report(self):
+        return dict(budget=self.fired, elapsed=self.elapsed, steps=self.steps, solver_time=self.solver_time)
@@ -0,0 +1,235 @@
+import logging
+import random
+
+l = logging.getLogger('WeightedSampler')
+
+
+class WeightedSampler(object):
+    """
+    Weighted random choice over a changing pool of items (i.e., SimStates).
+
+    Weights live in a Fenwick tree indexed by slot, items are keyed by identity, so insert,
+    remove, reweight and sample are all O(log n) and the pool can be kept across steps
+    instead of summing every weight and scanning the candidates at each selection.
+    Freed slots are reused and the tree doubles its capacity when it is full.
+    """
+
+    def __init__(self, rng=None, capacity=64):
+        """
+        :param rng:      The random.Random used for sampling (default: the random module).
+        :param capacity: Initial number of slots.
+        """
+        self._random = rng if rng is not None else random
+        self._capacity = 0
+        self._tree = [0.]
+        self._weights = []
+        self._items = []
+        self._slots = dict()
+        self._free = []
+        self._grow(capacity)
+
+    @classmethod
+    def from_items(cls, items, weight, rng=None):
+        """
+        Build a sampler in O(n).
+
+        :param items:  The items to sample from.
+        :param weight: A function returning the weight of an item.
+        """
+        items = list(items)
+        sampler = cls(rng=rng, capacity=max(1, len(items)))
+        for slot, item in enumerate(items):
+            sampler._items[slot] = item
+            sampler._weights[slot] = float(weight(item))
+            sampler._slots[id(item)] = slot
+        sampler._free = list(range(sampler._capacity - 1, len(items) - 1, -1))
+        sampler._rebuild()
+        return sampler
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, item):
+        return id(item) in self._slots
+
+    def __iter__(self):
+        return (self._items[slot] for slot in self._slots.values())
+
+    @property
+    def total(self):
+        return self._prefix(self._capacity)
+
+    def weight(self, item):
+        return self._weights[self._slots[id(item)]]
+
+    def add(self, item, weight):
+        """
+        Insert item with the given weight, or reweight it if it is already in the pool.
+        """
+        if weight < 0:
+            raise ValueError(f'negative weight {weight}')
+        slot = self._slots.get(id(item))
+        if slot is None:
+            if not self._free:
+                self._grow(self._capacity * 2)
+            slot = self._free.pop()
+            self._slots[id(item)] = slot
+            self._items[slot] = item
+        self._set(slot, float(weight))
+
+    update = add
+
+    def remove(self, item):
+        """
+        Remove item from the pool, do nothing if it is not there.
+        """
+        slot = self._slots.pop(id(item), None)
+        if slot is None:
+            return False
+        self._set(slot, 0.)
+        self._items[slot] = None
+        self._free.append(slot)
+        return True
+
+    def sample(self):
+        """
+        Pick an item with probability proportional to its weight, without removing it.
+        Items are picked uniformly if all the weights are zero.
+        """
+        if not self._slots:
+            return None
+        total = self.total
+        if total <= 0:
+            return self._random.choice(list(self))
+
+        slot = self._find(self._random.uniform(0, total))
+        if slot >= self._capacity or self._items[slot] is None or self._weights[slot] <= 0:
+            # floating point drift of the partial sums, start over from the weights
+            l.debug('rebuilding the sum tree')
+            self._rebuild()
+            slot = self._find(self._random.uniform(0, self.total))
+            if slot >= self._capacity or self._items[slot] is None:
+                slot = max(self._slots.values(), key=lambda s: self._weights[s])
+        return self._items[slot]
+
+    def pop(self):
+        item = self.sample()
+        if item is not None:
+            self.remove(item)
+        return item
+
+    def clear(self):
+        self.__init__(rng=self._random, capacity=self._capacity)
+
+    def _set(self, slot, weight):
+        delta = weight - self._weights[slot]
+        self._weights[slot] = weight
+        i = slot + 1
+        while i <= self._capacity:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, n):
+        s = 0.
+        while n > 0:
+            s += self._tree[n]
+            n -= n & -n
+        return s
+
+    def _find(self, target):
+        # descend the Fenwick tree to the first slot whose prefix sum exceeds target
+        pos = 0
+        mask = 1 << (self._capacity.bit_length() - 1)
+        while mask:
+            nxt = pos + mask
+            if nxt <= self._capacity and self._tree[nxt] <= target:
+                target -= self._tree[nxt]
+                pos = nxt
+            mask >>= 1
+        return pos
+
+    def _grow(self, capacity):
+        old = self._capacity
+        self._capacity = capacity
+        self._weights.extend([0.] * (capacity - old))
+        self._items.extend([None] * (capacity - old))
+        self._free.extend(range(capacity - 1, old - 1, -1))
+        self._rebuild()
+
+    def _rebuild(self):
+        tree = [0.] + self._weights[:]
+        for i in range(1, self._capacity + 1):
+            j = i + (i & -i)
+            if j <= self._capacity:
+                tree[j] += tree[i]
+        self._tree = tree
+
+
+class StashIndex(object):
+    """
+    Positions of the states of a stash list (i.e., 'deferred'), so that the state picked by a
+    sampler is removed from the list in O(1), swapping the last state into its place, instead of
+    list.remove scanning it.
+
+    States appended to the list are indexed when it is next synced. When another technique
+    replaces or shortens the list the positions are rebuilt, and states that are not in the list
+    anymore are reported as missing.
+    """
+
+    def __init__(self):
+        self.states = None
+        self.positions = dict()
+
+    def sync(self, states):
+        """
+        Follow the stash list.
+
+        :return: (reindexed, new): whether every position was rebuilt, and the states indexed by this call.
+        """
+        if states is not self.states or len(states) < len(self.positions):
+            self._reindex(states)
+            return True, list(states)
+        new = states[len(self.positions):]
+        for i, s in enumerate(new, len(self.positions)):
+            self.positions[id(s)] = i
+        return False, new
+
+    def position(self, states, state):
+        self.sync(states)
+        pos = self.positions.get(id(state))
+        if pos is None or pos >= len(states) or states[pos] is not state:
+            self._reindex(states)
+            pos = self.positions.get(id(state))
+        return pos
+
+    def append(self, states, state):
+        self.sync(states)
+        self.positions[id(state)] = len(states)
+        states.append(state)
+
+    def remove(self, states, state):
+        """
+        Remove state from states, False if it is not there.
+        """
+        pos = self.position(states, state)
+        if pos is None:
+            return False
+        del self.positions[id(state)]
+        last = states.pop()
+        if last is state:
+            return True
+        states[pos] = last
+        self.positions[id(last)] = pos
+        return True
+
+    def replace(self, state, other):
+        """
+        Let other take the place of state, i.e. a SpilledState stub and the state it stands for.
+        """
+        pos = self.positions.pop(id(state), None)
+        if pos is not None:
+            self.positions[id(other)] = pos
+
+    def _reindex(self, states):
+        self.states = states
+        self.positions = {id(s): i for i, s in enumerate(states)}